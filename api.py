@@ -7,28 +7,43 @@ Serves static website + API from Railway (no more Netlify needed)
 
 Endpoints:
 - GET / - index.html
-- GET /app.html, /app-es.html, /index-es.html - static pages
+- GET /*.html - static pages from static/ (ETag/Last-Modified, 304s)
 - POST /api/lesson - Generate lesson
+- POST /api/lesson/stream - Generate lesson as server-sent events
 - POST /api/share - Share to library
-- GET /api/lessons - Get lessons for carousel
+- GET /api/lessons - Get lessons for carousel (ETag, 304 on If-None-Match)
+- POST /api/lessons/batch - Queue bulk lesson generation
+- GET /api/lessons/batch/{id} - Batch status, then results as JSON lines
 - GET /api/health - Health check
 
-Deploy: uvicorn api:app --host 0.0.0.0 --port $PORT
+Deploy: python api.py (WEB_CONCURRENCY workers, uvloop + httptools)
 """
 
 import os
-import json
+import asyncio
+import fcntl
+import hashlib
 import logging
-from io import BytesIO
+import secrets
+import tempfile
+import time
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
+from types import MappingProxyType
 
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, HTMLResponse, FileResponse
+from fastapi.responses import Response, StreamingResponse, HTMLResponse, ORJSONResponse
+from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import Optional
-import anthropic
+from typing import List, Optional
+import anyio
+import orjson
+from cachetools import TTLCache
+from anthropic import APIConnectionError, AsyncAnthropic, InternalServerError, RateLimitError
 from fpdf import FPDF
 
 logging.basicConfig(level=logging.INFO)
@@ -38,13 +53,25 @@ ANTHROPIC_API_KEY = os.environ.get('ANTHROPIC_API_KEY') or os.environ.get('CLAUD
 if not ANTHROPIC_API_KEY:
     raise ValueError("ANTHROPIC_API_KEY or CLAUDE_API_KEY required")
 
-app = FastAPI(title="Tooley API", version="2.0.0")
-client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+app = FastAPI(title="Tooley API", version="2.0.0", default_response_class=ORJSONResponse)
+client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
 
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+CORS_ORIGINS = os.environ.get('CORS_ORIGINS', 'https://tooley.app,https://www.tooley.app,https://tooley-pwa-production.up.railway.app').split(',')
+app.add_middleware(CORSMiddleware, allow_origins=[o.strip() for o in CORS_ORIGINS if o.strip()], allow_credentials=True, allow_methods=["GET", "POST"], allow_headers=["Content-Type"], max_age=86400)
 
 STATIC_DIR = Path("static")
 LESSONS_FILE = "lessons.json"
+PDF_THREADS = 100
+# PDF rendering gets its own thread limiter: a burst of renders queues on it instead of
+# using up the default limiter that StaticFiles and other threadpool work share. anyio
+# builds limiters for the running event loop, so it's created on first use.
+_pdf_limiter = None
+
+def pdf_limiter() -> anyio.CapacityLimiter:
+    global _pdf_limiter
+    if _pdf_limiter is None:
+        _pdf_limiter = anyio.CapacityLimiter(PDF_THREADS)
+    return _pdf_limiter
 
 # Models
 class LessonRequest(BaseModel):
@@ -74,25 +101,116 @@ class ShareRequest(BaseModel):
     teacher_name: Optional[str] = "Anonymous"
     language: str = "en"
 
+class BatchLessonRequest(BaseModel):
+    items: List[LessonRequest]
+
 # Lessons storage
-def load_lessons():
+# The newest MAX_LESSONS live in a deque; shares are appended to a JSONL log and folded
+# back into the lessons.json snapshot at startup
+MAX_LESSONS = 100
+LESSONS_LOG = LESSONS_FILE + ".log"
+LESSONS_LOCK = LESSONS_FILE + ".lock"
+_LESSONS = deque(maxlen=MAX_LESSONS)
+
+# How far into the log this worker has replayed, and which lessons.json it was replayed onto
+_LOG_OFFSET = 0
+_SNAPSHOT = None
+
+@contextmanager
+def lessons_lock(kind):
+    # Workers append and replay under a shared lock; compaction takes it exclusively, so no
+    # share lands between reading the log and truncating it and no reader sees it half done
+    with open(LESSONS_LOCK, 'ab') as f:
+        fcntl.flock(f, kind)
+        yield
+
+def _snapshot_id():
+    try:
+        st = os.stat(LESSONS_FILE)
+        return st.st_ino, st.st_mtime_ns
+    except OSError:
+        return None
+
+def _load_lessons():
+    global _LOG_OFFSET, _SNAPSHOT
+    _LESSONS.clear()
+    _LOG_OFFSET = 0
+    _SNAPSHOT = _snapshot_id()
     try:
         if os.path.exists(LESSONS_FILE):
-            with open(LESSONS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f).get('lessons', [])
+            with open(LESSONS_FILE, 'rb') as f:
+                _LESSONS.extend(orjson.loads(f.read()).get('lessons', [])[:MAX_LESSONS])
     except Exception as e:
         logger.error(f"Load lessons error: {e}")
-    return []
+    return _sync_lessons()
+
+def _sync_lessons():
+    # Pick up log lines written since the last read, including shares made by other workers
+    global _LOG_OFFSET
+    if _snapshot_id() != _SNAPSHOT:
+        # Another worker compacted the log into a new lessons.json
+        return _load_lessons()
+    try:
+        size = os.path.getsize(LESSONS_LOG)
+    except OSError:
+        size = 0
+    if size == _LOG_OFFSET:
+        return 0
+    replayed = 0
+    try:
+        seen = {(l.get('id'), l.get('created_at')) for l in _LESSONS}
+        with open(LESSONS_LOG, 'rb') as f:
+            f.seek(_LOG_OFFSET)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # partial write, pick it up next time
+                _LOG_OFFSET += len(line)
+                if line.strip():
+                    lesson = orjson.loads(line)
+                    if (lesson.get('id'), lesson.get('created_at')) not in seen:
+                        _LESSONS.appendleft(lesson)
+                    replayed += 1
+    except Exception as e:
+        logger.error(f"Replay lessons log error: {e}")
+    return replayed
+
+def sync_lessons():
+    with lessons_lock(fcntl.LOCK_SH):
+        return _sync_lessons()
 
 def save_lessons(lessons):
     try:
-        with open(LESSONS_FILE, 'w', encoding='utf-8') as f:
-            json.dump({'lessons': lessons, 'updated': datetime.utcnow().isoformat()}, f, indent=2, ensure_ascii=False)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(LESSONS_FILE)), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(orjson.dumps({'lessons': lessons, 'updated': datetime.utcnow().isoformat()}, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, LESSONS_FILE)
         return True
     except Exception as e:
         logger.error(f"Save lessons error: {e}")
         return False
 
+def append_lesson_log(lesson):
+    try:
+        with lessons_lock(fcntl.LOCK_SH), open(LESSONS_LOG, 'ab') as f:
+            f.write(orjson.dumps(lesson) + b"\n")
+    except Exception as e:
+        logger.error(f"Append lessons log error: {e}")
+
+@app.on_event("startup")
+async def restore_lessons():
+    # Compact the log into a fresh snapshot so it never grows past one process lifetime. Every
+    # worker runs this, but under the exclusive lock only one compacts at a time, and a worker
+    # that finds the log already folded in just loads the snapshot.
+    global _LOG_OFFSET, _SNAPSHOT
+    with lessons_lock(fcntl.LOCK_EX):
+        if _load_lessons() and save_lessons(list(_LESSONS)):
+            # Truncate rather than unlink so every worker keeps appending to the same file
+            with open(LESSONS_LOG, 'r+b') as f:
+                f.truncate(0)
+            _LOG_OFFSET = 0
+            _SNAPSHOT = _snapshot_id()
+    logger.info(f"Loaded {len(_LESSONS)} lessons")
+
 # Lesson generation
 SYSTEM_EN = """You are Tooley, an expert educational assistant. Generate clear, practical lesson plans.
 Focus on active learning, student engagement, and real-world connections.
@@ -102,71 +220,172 @@ SYSTEM_ES = """Eres Tooley, asistente educativo experto. Genera planes de lecci
 Enfócate en aprendizaje activo, participación estudiantil y conexiones con el mundo real.
 Escribe en español claro. Usa pasos numerados y viñetas. Cada sección DEBE tener contenido."""
 
+MATERIALS_ES = MappingProxyType({'none': 'SIN MATERIALES', 'basic': 'Materiales básicos - papel, lápices, pizarra', 'standard': 'Útiles completos'})
+STYLES_ES = MappingProxyType({'interactive': 'Métodos interactivos con juegos y actividades.', 'structured': 'Enfoque estructurado dirigido por el docente.', 'storytelling': 'Narrativa y cuentos.', 'mixed': 'Estilos equilibrados.'})
+MATERIALS_EN = MappingProxyType({'none': 'NO MATERIALS', 'basic': 'Basic materials - paper, pencils, blackboard', 'standard': 'Full classroom supplies'})
+STYLES_EN = MappingProxyType({'interactive': 'Interactive methods with games and activities.', 'structured': 'Structured teacher-led approach.', 'storytelling': 'Narrative and storytelling.', 'mixed': 'Balanced styles.'})
+
+@lru_cache(maxsize=256)
+def _split(duration: str) -> tuple:
+    """Introduction / main activity / wrap-up minutes for a lesson length"""
+    d = int(duration)
+    return int(d * 0.15), int(d * 0.6), int(d * 0.25)
+
 def build_prompt(p: LessonRequest) -> str:
-    if p.language == 'es':
-        mat = {'none': 'SIN MATERIALES', 'basic': 'Materiales básicos - papel, lápices, pizarra', 'standard': 'Útiles completos'}
-        sty = {'interactive': 'Métodos interactivos con juegos y actividades.', 'structured': 'Enfoque estructurado dirigido por el docente.', 'storytelling': 'Narrativa y cuentos.', 'mixed': 'Estilos equilibrados.'}
+    return _build_prompt(p.subject, p.topic, p.ages, p.duration, p.country, p.materials, p.style, p.language)
+
+@lru_cache(maxsize=2048)
+def _build_prompt(subject, topic, ages, duration, country, materials, style, language) -> str:
+    intro, main, wrap = _split(duration)
+    if language == 'es':
+        mat, sty = MATERIALS_ES, STYLES_ES
         return f"""Crea un plan de lección:
-**Materia:** {p.subject}
-**Tema:** {p.topic}
-**Edades:** {p.ages} años
-**Duración:** {p.duration} minutos
-**Ubicación:** {p.country}
-**Materiales:** {mat.get(p.materials, mat['basic'])}
-**Estilo:** {sty.get(p.style, sty['mixed'])}
+**Materia:** {subject}
+**Tema:** {topic}
+**Edades:** {ages} años
+**Duración:** {duration} minutos
+**Ubicación:** {country}
+**Materiales:** {mat.get(materials, mat['basic'])}
+**Estilo:** {sty.get(style, sty['mixed'])}
 
 Secciones requeridas:
 ## Objetivos de Aprendizaje
 ## Materiales Necesarios
-## Introducción ({int(int(p.duration)*0.15)} min)
-## Actividad Principal ({int(int(p.duration)*0.6)} min)
-## Cierre y Evaluación ({int(int(p.duration)*0.25)} min)
+## Introducción ({intro} min)
+## Actividad Principal ({main} min)
+## Cierre y Evaluación ({wrap} min)
 ## Consejos de Diferenciación
 ## Preguntas de Comprensión
 ## Consejos para el Docente"""
     else:
-        mat = {'none': 'NO MATERIALS', 'basic': 'Basic materials - paper, pencils, blackboard', 'standard': 'Full classroom supplies'}
-        sty = {'interactive': 'Interactive methods with games and activities.', 'structured': 'Structured teacher-led approach.', 'storytelling': 'Narrative and storytelling.', 'mixed': 'Balanced styles.'}
+        mat, sty = MATERIALS_EN, STYLES_EN
         return f"""Create a lesson plan:
-**Subject:** {p.subject}
-**Topic:** {p.topic}
-**Ages:** {p.ages} years
-**Duration:** {p.duration} minutes
-**Location:** {p.country}
-**Materials:** {mat.get(p.materials, mat['basic'])}
-**Style:** {sty.get(p.style, sty['mixed'])}
+**Subject:** {subject}
+**Topic:** {topic}
+**Ages:** {ages} years
+**Duration:** {duration} minutes
+**Location:** {country}
+**Materials:** {mat.get(materials, mat['basic'])}
+**Style:** {sty.get(style, sty['mixed'])}
 
 Required sections:
 ## Learning Objectives
 ## Materials Needed
-## Lesson Introduction ({int(int(p.duration)*0.15)} min)
-## Main Activity ({int(int(p.duration)*0.6)} min)
-## Wrap-Up & Assessment ({int(int(p.duration)*0.25)} min)
+## Lesson Introduction ({intro} min)
+## Main Activity ({main} min)
+## Wrap-Up & Assessment ({wrap} min)
 ## Differentiation Tips
 ## Comprehension Questions
 ## Teacher Tips"""
 
-def generate_lesson(p: LessonRequest) -> str:
+LESSON_MODEL = "claude-sonnet-4-20250514"
+LESSON_MAX_TOKENS = 3000
+MAX_BATCH_ITEMS = 100
+
+def lesson_message_params(p: LessonRequest) -> dict:
+    return {
+        "model": LESSON_MODEL,
+        "max_tokens": LESSON_MAX_TOKENS,
+        "system": SYSTEM_ES if p.language == 'es' else SYSTEM_EN,
+        "messages": [{"role": "user", "content": build_prompt(p)}],
+    }
+
+# Identical requests reuse the previous lesson instead of paying for another Claude call
+LESSON_CACHE = TTLCache(maxsize=10_000, ttl=7 * 86400)
+
+def lesson_cache_key(p: LessonRequest) -> bytes:
+    return hashlib.blake2b(orjson.dumps(p.dict(), option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+
+# Cap in-flight Claude calls per worker and absorb 429s here instead of failing the request
+ANTHROPIC_SEMAPHORE = asyncio.Semaphore(int(os.environ.get('ANTHROPIC_MAX_CONCURRENT', 20)))
+ANTHROPIC_RETRIES = 5
+ANTHROPIC_MAX_DELAY = 60.0
+# Lesson streams retry in the loop below, so the SDK's own retries are off for them; otherwise
+# each attempt here would be up to three requests while holding a semaphore permit
+lesson_client = client.with_options(max_retries=0)
+# What the SDK itself would have retried: 429s, overloaded/5xx responses and dropped connections
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+
+def retry_delay(e: Exception, attempt: int) -> float:
+    # Exponential backoff, but never sooner than the server's Retry-After asks
+    delay = 2 ** attempt
+    response = getattr(e, 'response', None)
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get('retry-after', 0)))
+        except ValueError:
+            pass
+    return min(delay, ANTHROPIC_MAX_DELAY)
+
+async def _produce_lesson(p: LessonRequest, key: bytes, out: asyncio.Queue):
+    # Holds a semaphore permit only while Claude streams; the text goes into an unbounded
+    # queue, so a slow SSE reader never keeps a permit from other requests
+    parts = []
+    try:
+        async with ANTHROPIC_SEMAPHORE:
+            for attempt in range(ANTHROPIC_RETRIES):
+                try:
+                    async with lesson_client.messages.stream(**lesson_message_params(p)) as stream:
+                        async for text in stream.text_stream:
+                            parts.append(text)
+                            out.put_nowait(text)
+                    break
+                except RETRYABLE_ERRORS as e:
+                    # Only retry before anything has been sent downstream
+                    if parts or attempt == ANTHROPIC_RETRIES - 1:
+                        raise
+                    delay = retry_delay(e, attempt)
+                    logger.warning(f"{type(e).__name__}, retrying in {delay}s ({attempt + 1}/{ANTHROPIC_RETRIES})")
+                    await asyncio.sleep(delay)
+        LESSON_CACHE[key] = ''.join(parts)
+        out.put_nowait(None)
+    except Exception as e:
+        out.put_nowait(e)
+
+async def stream_lesson(p: LessonRequest):
+    """Yield the lesson text as Claude produces it; cache hits arrive as one chunk"""
+    key = lesson_cache_key(p)
+    cached = LESSON_CACHE.get(key)
+    if cached is not None:
+        logger.info(f"Cache hit: {p.subject} - {p.topic} ({p.language})")
+        yield cached
+        return
     logger.info(f"Generating: {p.subject} - {p.topic} ({p.language})")
-    response = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=3000,
-        system=SYSTEM_ES if p.language == 'es' else SYSTEM_EN,
-        messages=[{"role": "user", "content": build_prompt(p)}]
-    )
-    return response.content[0].text
+    out = asyncio.Queue()
+    producer = asyncio.create_task(_produce_lesson(p, key, out))
+    try:
+        while (item := await out.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # A client that disconnects mid-stream stops the Claude call too
+        producer.cancel()
 
-# PDF generation
-def ascii_only(text: str) -> str:
-    for old, new in {'á':'a','é':'e','í':'i','ó':'o','ú':'u','Á':'A','É':'E','Í':'I','Ó':'O','Ú':'U','ñ':'n','Ñ':'N','ü':'u','¿':'?','¡':'!','–':'-','—':'-','"':'"','"':'"',''': "'",''': "'"}.items():
-        text = text.replace(old, new)
-    return ''.join(c if ord(c) < 128 else ' ' for c in text)
+async def generate_lesson(p: LessonRequest) -> str:
+    return ''.join([text async for text in stream_lesson(p)])
 
-def create_pdf(content: str, params: dict) -> BytesIO:
-    pdf = FPDF()
-    pdf.set_auto_page_break(auto=True, margin=20)
-    pdf.add_page()
-    
+# PDF generation
+class _AsciiFallback(dict):
+    """Translation table that maps any unlisted non-ASCII code point to a space"""
+    def __missing__(self, key):
+        return 32 if key >= 128 else key
+
+_ASCII_TABLE = _AsciiFallback(str.maketrans({
+    'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u', 'Á': 'A', 'É': 'E', 'Í': 'I', 'Ó': 'O', 'Ú': 'U',
+    'ñ': 'n', 'Ñ': 'N', 'ü': 'u', '¿': '?', '¡': '!', '–': '-', '—': '-',
+    '\u201c': '"', '\u201d': '"', '\u2018': "'", '\u2019': "'",
+}))
+
+def ascii_only(text) -> str:
+    if not isinstance(text, str):
+        text = str(text)
+    # Claude output is mostly plain ASCII already; isascii() is a single C-level check
+    if text.isascii():
+        return text
+    return text.translate(_ASCII_TABLE)
+
+def _draw_header(pdf: FPDF):
     pdf.set_fill_color(217, 119, 6)
     pdf.rect(10, 10, 4, 12, 'F')
     pdf.set_xy(18, 10)
@@ -178,98 +397,120 @@ def create_pdf(content: str, params: dict) -> BytesIO:
     pdf.set_text_color(100, 100, 100)
     pdf.cell(50, 8, 'tooley.app', align='R')
     pdf.ln(20)
+
+_SPEC_FIELDS = (('subject', 'Subject'), ('topic', 'Topic'), ('ages', 'Ages'), ('duration', 'Duration'), ('country', 'Country'))
+_BODY_STYLE = (('Helvetica', '', 10), (15, 23, 42))
+_HEADING_STYLE = (('Helvetica', 'B', 12), (217, 119, 6))
+
+@lru_cache(maxsize=256)
+def parse_content(content: str) -> tuple:
+    """Classify lesson lines once into ('blank' | 'h2' | 'text', ASCII text) pairs"""
+    lines = []
+    for line in content.split('\n'):
+        line = line.strip()
+        c = line[:1]
+        if not c:
+            lines.append(('blank', ''))
+        elif c == '#' and line.startswith('## '):
+            lines.append(('h2', ascii_only(line[3:])))
+        elif c in '-*' and line[1:2] == ' ':
+            lines.append(('text', '  * ' + ascii_only(line[2:])))
+        else:
+            lines.append(('text', ascii_only(line).replace('**', '')))
+    return tuple(lines)
+
+def create_pdf(content: str, params: dict) -> bytes:
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=20)
+    pdf.add_page()
+    _draw_header(pdf)
     
-    if any(params.values()):
+    spec_lines = [f"{label}: {params[key]}" for key, label in _SPEC_FIELDS if params.get(key)]
+    if spec_lines:
         pdf.set_fill_color(255, 251, 235)
         pdf.set_draw_color(15, 23, 42)
         specs_y = pdf.get_y()
-        spec_lines = [f"{k.title()}: {v}" for k, v in params.items() if v]
-        if spec_lines:
-            box_h = 8 + len(spec_lines) * 5
-            pdf.rect(10, specs_y, 190, box_h, 'FD')
-            pdf.set_xy(15, specs_y + 3)
-            pdf.set_font('Helvetica', 'B', 9)
-            pdf.set_text_color(217, 119, 6)
-            pdf.cell(0, 5, 'LESSON SPECIFICATIONS')
-            pdf.set_font('Helvetica', '', 9)
-            pdf.set_text_color(15, 23, 42)
-            for i, line in enumerate(spec_lines):
-                pdf.set_xy(15, specs_y + 8 + i * 5)
-                pdf.cell(0, 5, ascii_only(line))
-            pdf.set_y(specs_y + box_h + 10)
+        box_h = 8 + len(spec_lines) * 5
+        pdf.rect(10, specs_y, 190, box_h, 'FD')
+        pdf.set_xy(15, specs_y + 3)
+        pdf.set_font('Helvetica', 'B', 9)
+        pdf.set_text_color(217, 119, 6)
+        pdf.cell(0, 5, 'LESSON SPECIFICATIONS')
+        pdf.set_font('Helvetica', '', 9)
+        pdf.set_text_color(15, 23, 42)
+        for i, line in enumerate(spec_lines):
+            pdf.set_xy(15, specs_y + 8 + i * 5)
+            pdf.cell(0, 5, ascii_only(line))
+        pdf.set_y(specs_y + box_h + 10)
     
-    pdf.set_font('Helvetica', '', 10)
-    pdf.set_text_color(15, 23, 42)
+    # Body and bullet lines share a style, so consecutive ones go out in a single multi_cell.
+    # Font and colour are only re-sent to FPDF when the style actually changes.
+    current = None
+    run = []
     
-    for line in content.split('\n'):
-        line = line.strip()
-        if not line:
-            pdf.ln(3)
+    def use(style):
+        nonlocal current
+        if style is not current:
+            pdf.set_font(*style[0])
+            pdf.set_text_color(*style[1])
+            current = style
+    
+    def flush():
+        if run:
+            use(_BODY_STYLE)
+            pdf.multi_cell(0, 5, '\n'.join(run))
+            run.clear()
+    
+    for kind, text in parse_content(content):
+        if kind == 'text':
+            run.append(text)
             continue
-        safe = ascii_only(line)
-        if line.startswith('## '):
-            pdf.ln(5)
-            pdf.set_font('Helvetica', 'B', 12)
-            pdf.set_text_color(217, 119, 6)
-            pdf.multi_cell(0, 6, safe[3:])
-            pdf.set_font('Helvetica', '', 10)
-            pdf.set_text_color(15, 23, 42)
-        elif line.startswith('- ') or line.startswith('* '):
-            pdf.multi_cell(0, 5, '  * ' + safe[2:])
+        flush()
+        if kind == 'blank':
+            pdf.ln(3)
         else:
-            pdf.multi_cell(0, 5, safe.replace('**', ''))
+            pdf.ln(5)
+            use(_HEADING_STYLE)
+            pdf.multi_cell(0, 6, text)
+    flush()
     
     pdf.set_y(-20)
     pdf.set_font('Helvetica', '', 8)
     pdf.set_text_color(128, 128, 128)
     pdf.cell(0, 10, 'Generated by Tooley | tooley.app | Free for all teachers', align='C')
     
-    buffer = BytesIO()
-    pdf.output(buffer)
-    buffer.seek(0)
-    return buffer
-
-# Static file routes
-@app.get("/", response_class=HTMLResponse)
-async def serve_index():
-    f = STATIC_DIR / "index.html"
-    return FileResponse(f, media_type="text/html") if f.exists() else HTMLResponse("<h1>Tooley API v2.0</h1><p>Visit /api/health</p>")
-
-@app.get("/index.html", response_class=HTMLResponse)
-async def serve_index_html():
-    return await serve_index()
-
-@app.get("/index-es.html", response_class=HTMLResponse)
-async def serve_index_es():
-    f = STATIC_DIR / "index-es.html"
-    return FileResponse(f, media_type="text/html") if f.exists() else HTMLResponse("<h1>Tooley</h1>")
-
-@app.get("/app.html", response_class=HTMLResponse)
-async def serve_app():
-    f = STATIC_DIR / "app.html"
-    return FileResponse(f, media_type="text/html") if f.exists() else HTMLResponse("<h1>Tooley App</h1>")
-
-@app.get("/app-es.html", response_class=HTMLResponse)
-async def serve_app_es():
-    f = STATIC_DIR / "app-es.html"
-    return FileResponse(f, media_type="text/html") if f.exists() else HTMLResponse("<h1>Tooley App</h1>")
+    return bytes(pdf.output())
+
+# Download names only change once a second; reuse the formatted one within that second
+_PDF_FILENAME = [0, '']
+
+def pdf_filename() -> str:
+    now = int(time.time())
+    if now != _PDF_FILENAME[0]:
+        _PDF_FILENAME[:] = [now, time.strftime('tooley-lesson-%Y%m%d-%H%M%S.pdf', time.localtime(now))]
+    return _PDF_FILENAME[1]
 
 # API endpoints
 @app.get("/api/health")
 async def health():
     return {"status": "ok", "version": "2.0.0", "timestamp": datetime.utcnow().isoformat()}
 
-@app.get("/api/lessons")
-async def get_lessons():
-    lessons = load_lessons()
-    return {"lessons": lessons, "count": len(lessons)}
+@app.api_route("/api/lessons", methods=["GET", "HEAD"])
+async def get_lessons(request: Request):
+    sync_lessons()
+    latest = _LESSONS[0] if _LESSONS else {}
+    tag = f"{len(_LESSONS)}-{latest.get('id', '')}-{latest.get('created_at') or latest.get('created', '')}"
+    etag = '"' + hashlib.blake2b(tag.encode(), digest_size=8).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=30"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse({"lessons": list(_LESSONS), "count": len(_LESSONS)}, headers=headers)
 
 @app.post("/api/share")
-async def share_lesson(request: ShareRequest):
+async def share_lesson(request: ShareRequest, background: BackgroundTasks):
     try:
-        lessons = load_lessons()
         new_lesson = {
-            "id": f"lesson_{datetime.now().strftime('%Y%m%d%H%M%S')}_{len(lessons)}",
+            "id": f"lesson_{datetime.now().strftime('%Y%m%d%H%M%S')}_{secrets.token_hex(4)}",
             "subject": request.subject,
             "topic": request.topic,
             "ages": request.ages,
@@ -279,12 +520,10 @@ async def share_lesson(request: ShareRequest):
             "language": request.language,
             "created_at": datetime.utcnow().isoformat()
         }
-        lessons.insert(0, new_lesson)
-        lessons = lessons[:100]
-        if save_lessons(lessons):
-            logger.info(f"Shared: {request.subject} - {request.topic}")
-            return {"success": True, "lesson": new_lesson}
-        raise HTTPException(status_code=500, detail="Failed to save")
+        _LESSONS.appendleft(new_lesson)
+        background.add_task(append_lesson_log, new_lesson)
+        logger.info(f"Shared: {request.subject} - {request.topic}")
+        return {"success": True, "lesson": new_lesson}
     except Exception as e:
         logger.error(f"Share error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -292,22 +531,89 @@ async def share_lesson(request: ShareRequest):
 @app.post("/api/lesson")
 async def create_lesson(request: LessonRequest):
     try:
-        lesson = generate_lesson(request)
+        lesson = await generate_lesson(request)
         return {"lesson": lesson, "params": request.dict()}
+    except RateLimitError as e:
+        logger.error(f"Lesson rate limited: {e}")
+        raise HTTPException(status_code=503, detail="Busy, please try again shortly", headers={"Retry-After": "30"})
     except Exception as e:
         logger.error(f"Lesson error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/lesson/stream")
+async def create_lesson_stream(request: LessonRequest):
+    async def events():
+        try:
+            async for text in stream_lesson(request):
+                yield b"data: " + orjson.dumps({"delta": text}) + b"\n\n"
+            yield b"event: done\ndata: {}\n\n"
+        except Exception as e:
+            logger.error(f"Lesson stream error: {e}")
+            yield b"event: error\ndata: " + orjson.dumps({"detail": str(e)}) + b"\n\n"
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Bulk generation goes through the Message Batches API: half price and outside the RPM limits
+@app.post("/api/lessons/batch")
+async def create_lesson_batch(request: BatchLessonRequest):
+    if not request.items or len(request.items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {MAX_BATCH_ITEMS} lessons")
+    try:
+        batch = await client.messages.batches.create(requests=[
+            {"custom_id": f"i{idx}", "params": lesson_message_params(p)}
+            for idx, p in enumerate(request.items)
+        ])
+        logger.info(f"Batch created: {batch.id} ({len(request.items)} lessons)")
+        return {"batch_id": batch.id, "status": batch.processing_status}
+    except Exception as e:
+        logger.error(f"Batch error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/lessons/batch/{batch_id}")
+async def get_lesson_batch(batch_id: str):
+    try:
+        batch = await client.messages.batches.retrieve(batch_id)
+    except Exception as e:
+        logger.error(f"Batch lookup error: {e}")
+        raise HTTPException(status_code=404, detail=str(e))
+    if batch.processing_status != "ended":
+        return {"batch_id": batch.id, "status": batch.processing_status, "counts": batch.request_counts.dict()}
+
+    async def results():
+        async for entry in await client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                line = {"id": entry.custom_id, "lesson": entry.result.message.content[0].text}
+            else:
+                line = {"id": entry.custom_id, "error": entry.result.type}
+            yield orjson.dumps(line) + b"\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
 @app.post("/api/pdf")
 async def create_pdf_endpoint(request: PDFRequest):
     try:
         params = {'subject': request.subject, 'topic': request.topic, 'ages': request.ages, 'duration': request.duration, 'country': request.country}
-        pdf_buffer = create_pdf(request.content, params)
-        return StreamingResponse(pdf_buffer, media_type="application/pdf", headers={"Content-Disposition": f"attachment; filename=tooley-lesson-{datetime.now().strftime('%Y%m%d-%H%M%S')}.pdf"})
+        pdf_bytes = await anyio.to_thread.run_sync(create_pdf, request.content, params, limiter=pdf_limiter())
+        return Response(content=pdf_bytes, media_type="application/pdf", headers={"Content-Disposition": f"attachment; filename={pdf_filename()}"})
     except Exception as e:
         logger.error(f"PDF error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Static site - mounted last so /api/* routes win
+if STATIC_DIR.is_dir():
+    app.mount("/", StaticFiles(directory=STATIC_DIR, html=True), name="static")
+else:
+    @app.get("/", response_class=HTMLResponse)
+    async def serve_index():
+        return HTMLResponse("<h1>Tooley API v2.0</h1><p>Visit /api/health</p>")
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8000)))
+    uvicorn.run(
+        "api:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8000)),
+        workers=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="uvloop",
+        http="httptools",
+        log_level="info",
+    )
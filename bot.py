@@ -36,19 +36,32 @@ Stack:
 VERSION = "2.11.0"
 
 import os
+import asyncio
 import logging
-import json
 import hashlib
 import base64
 import random
 import re
-import traceback
+import secrets
+import sqlite3
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
-from io import BytesIO
+from enum import IntEnum
+from functools import lru_cache, wraps
+from html import escape
+from types import MappingProxyType
 import httpx
+import orjson
+from cachetools import LRUCache, TTLCache
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.constants import ChatAction, ParseMode
+from telegram.error import TelegramError
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -56,8 +69,8 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-from anthropic import Anthropic
-from groq import Groq
+from anthropic import AsyncAnthropic
+from groq import AsyncGroq
 from fpdf import FPDF
 
 # ============================================================================
@@ -72,6 +85,8 @@ GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
 GITHUB_REPO = os.environ.get("GITHUB_REPO", "tooley/lesson-library")
 GITHUB_WEBSITE_REPO = os.environ.get("GITHUB_WEBSITE_REPO")
 LESSONS_FILE = "lessons.json"
+SESSION_DB = os.environ.get("SESSION_DB", "sessions.db")
+REDIS_URL = os.environ.get("REDIS_URL")
 
 # ============================================================================
 # TRANSLATIONS
@@ -80,24 +95,24 @@ LESSONS_FILE = "lessons.json"
 TRANSLATIONS = {
     "en": {
         # Language selection
-        "lang_prompt": "🌐 *Choose your language:*",
+        "lang_prompt": "🌐 <b>Choose your language:</b>",
         "lang_english": "🇬🇧 English",
         "lang_spanish": "🇪🇸 Español",
         "lang_changed": "✅ Language set to English",
         
         # Welcome & Menu
-        "welcome": "👋 *Welcome to Tooley!*\n\nI create lesson plans for teachers around the world.\n\nWhat would you like to do?",
-        "welcome_back": "👋 *Welcome to Tooley!*\n\nWhat would you like to do?",
+        "welcome": "👋 <b>Welcome to Tooley!</b>\n\nI create lesson plans for teachers around the world.\n\nWhat would you like to do?",
+        "welcome_back": "👋 <b>Welcome to Tooley!</b>\n\nWhat would you like to do?",
         "quick_lesson": "⚡ Quick Lesson",
         "custom_lesson": "✨ Custom Lesson",
         "help_tips": "❓ Help & Tips",
         "change_language": "🌐 Language",
         
         # Quick Lesson
-        "quick_title": "⚡ *Quick Lesson*\n\nPick a subject and I'll generate instantly!\n_Smart defaults: Ages 9-11, 30 min, basic materials_",
+        "quick_title": "⚡ <b>Quick Lesson</b>\n\nPick a subject and I'll generate instantly!\n<i>Smart defaults: Ages 9-11, 30 min, basic materials</i>",
         
         # Subjects
-        "subject_prompt": "📚 *Let's create a lesson!*\n\nWhat subject?",
+        "subject_prompt": "📚 <b>Let's create a lesson!</b>\n\nWhat subject?",
         "subj_mathematics": "📐 Mathematics",
         "subj_science": "🔬 Science",
         "subj_reading": "📖 Reading",
@@ -108,7 +123,7 @@ TRANSLATIONS = {
         "subject_other_prompt": "Type your subject:",
         
         # Topic
-        "topic_prompt": "📝 *Topic*\n\nChoose a suggestion or type your own:",
+        "topic_prompt": "📝 <b>Topic</b>\n\nChoose a suggestion or type your own:",
         "topic_custom": "✏️ Type my own",
         "topic_type_prompt": "Type your topic:",
         
@@ -120,7 +135,7 @@ TRANSLATIONS = {
         "min": "min",
         
         # Country
-        "country_prompt": "📍 *Where do you teach?*\n\n_This helps tailor the lesson to your curriculum._",
+        "country_prompt": "📍 <b>Where do you teach?</b>\n\n<i>This helps tailor the lesson to your curriculum.</i>",
         "country_global": "🌍 Global",
         
         # Materials
@@ -137,7 +152,7 @@ TRANSLATIONS = {
         "style_mixed": "⚖️ Mixed",
         
         # Format
-        "format_prompt": "📲 *Choose format:*\n• _Chat_ = read here\n• _PDF_ = print\n• _HTML_ = browser",
+        "format_prompt": "📲 <b>Choose format:</b>\n• <i>Chat</i> = read here\n• <i>PDF</i> = print\n• <i>HTML</i> = browser",
         "fmt_chat": "📱 Chat only",
         "fmt_pdf": "📄 PDF only",
         "fmt_html": "🌐 HTML only",
@@ -145,17 +160,17 @@ TRANSLATIONS = {
         "fmt_chathtml": "📱+🌐 Chat+HTML",
         
         # Generation
-        "generating": "⏳ *Generating your lesson...*\n\n_This may take 15-30 seconds._",
-        "lesson_ready": "✅ *Your lesson is ready!*",
+        "generating": "⏳ <b>Generating your lesson...</b>\n\n<i>This may take 15-30 seconds.</i>",
+        "lesson_ready": "✅ <b>Your lesson is ready!</b>",
         "generation_error": "❌ Error generating lesson. Please try again.",
         
         # Sharing
-        "share_prompt": "🌍 *Share with the community?*\n\nYour lesson will appear on tooley.app for other teachers to use.",
+        "share_prompt": "🌍 <b>Share with the community?</b>\n\nYour lesson will appear on tooley.app for other teachers to use.",
         "share_yes": "✅ Yes, share",
         "share_no": "🔒 Keep private",
-        "share_name_prompt": "🌍 *Thank you!*\n\nYour name? (or 'skip' for anonymous)",
-        "share_success": "🎉 *Shared!*\n\n📍 Live on tooley.app!\n\nWhat's next?",
-        "share_success_basic": "🎉 *Shared!*\n\nWhat's next?",
+        "share_name_prompt": "🌍 <b>Thank you!</b>\n\nYour name? (or 'skip' for anonymous)",
+        "share_success": "🎉 <b>Shared!</b>\n\n📍 Live on tooley.app!\n\nWhat's next?",
+        "share_success_basic": "🎉 <b>Shared!</b>\n\nWhat's next?",
         "saved_private": "👍 Saved privately.\n\nWhat's next?",
         
         # Actions
@@ -164,7 +179,7 @@ TRANSLATIONS = {
         "back": "← Back",
         
         # Summary
-        "summary_header": "━━━━ *Your Lesson* ━━━━",
+        "summary_header": "━━━━ <b>Your Lesson</b> ━━━━",
         "summary_footer": "━━━━━━━━━━━━━━━━━━",
         "lbl_subject": "📚 Subject",
         "lbl_topic": "📝 Topic",
@@ -175,18 +190,18 @@ TRANSLATIONS = {
         "lbl_style": "🎯 Style",
         
         # Help
-        "help_text": "*Tooley Help*\n\n⚡ *Quick* — Pick subject, I handle the rest\n✨ *Custom* — Full control\n\n*Formats:*\n📱 Chat = read here\n📄 PDF = print\n🌐 HTML = browser\n\n*Sharing:* Your lessons appear on tooley.app!",
-        "help_command": "*Tooley Help*\n\n/start - Main menu\n/lesson - Start new lesson\n/subjects - See available subjects\n/language - Change language\n/about - About Tooley\n/feedback - Send us feedback\n/help - This help\n\n*Formats:*\n📱 Chat = read in Telegram\n📄 PDF = download for printing\n🌐 HTML = opens in browser",
+        "help_text": "<b>Tooley Help</b>\n\n⚡ <b>Quick</b> — Pick subject, I handle the rest\n✨ <b>Custom</b> — Full control\n\n<b>Formats:</b>\n📱 Chat = read here\n📄 PDF = print\n🌐 HTML = browser\n\n<b>Sharing:</b> Your lessons appear on tooley.app!",
+        "help_command": "<b>Tooley Help</b>\n\n/start - Main menu\n/lesson - Start new lesson\n/subjects - See available subjects\n/language - Change language\n/about - About Tooley\n/feedback - Send us feedback\n/help - This help\n\n<b>Formats:</b>\n📱 Chat = read in Telegram\n📄 PDF = download for printing\n🌐 HTML = opens in browser",
         
         # About
-        "about": "📚 *About Tooley*\n\nTooley is a free AI-powered lesson plan generator built for teachers in low-resource schools.\n\n🎯 *Our Mission*\nEvery teacher deserves quality lesson plans, regardless of resources or location.\n\n✨ *Features*\n• Create complete lesson plans in minutes\n• Curriculum-aligned content\n• Multiple subjects supported\n• Download as PDF for offline use\n• Always free\n\n🌍 *Community*\nJoin thousands of teachers worldwide using Tooley.\n\n💛 Built with love for teachers everywhere.\n\n🔗 tooley.app",
+        "about": "📚 <b>About Tooley</b>\n\nTooley is a free AI-powered lesson plan generator built for teachers in low-resource schools.\n\n🎯 <b>Our Mission</b>\nEvery teacher deserves quality lesson plans, regardless of resources or location.\n\n✨ <b>Features</b>\n• Create complete lesson plans in minutes\n• Curriculum-aligned content\n• Multiple subjects supported\n• Download as PDF for offline use\n• Always free\n\n🌍 <b>Community</b>\nJoin thousands of teachers worldwide using Tooley.\n\n💛 Built with love for teachers everywhere.\n\n🔗 tooley.app",
         
         # Subjects list
-        "subjects_list": "📚 *Available Subjects*\n\n📐 *Mathematics* - Numbers, geometry, algebra, problem-solving\n\n🔬 *Science* - Biology, physics, chemistry, nature\n\n📖 *Reading* - Comprehension, phonics, literature\n\n✏️ *Language Arts* - Writing, grammar, vocabulary\n\n🌍 *Social Studies* - History, geography, civics\n\n🎨 *Art & Music* - Creative expression, crafts\n\n📝 *Other* - Any custom topic you need!\n\nReady? Use /lesson to create a plan!",
+        "subjects_list": "📚 <b>Available Subjects</b>\n\n📐 <b>Mathematics</b> - Numbers, geometry, algebra, problem-solving\n\n🔬 <b>Science</b> - Biology, physics, chemistry, nature\n\n📖 <b>Reading</b> - Comprehension, phonics, literature\n\n✏️ <b>Language Arts</b> - Writing, grammar, vocabulary\n\n🌍 <b>Social Studies</b> - History, geography, civics\n\n🎨 <b>Art &amp; Music</b> - Creative expression, crafts\n\n📝 <b>Other</b> - Any custom topic you need!\n\nReady? Use /lesson to create a plan!",
         
         # Feedback
-        "feedback_prompt": "💬 *We'd love your feedback!*\n\nTell us:\n• What's working well?\n• What could be better?\n• What features would you like?\n\nJust type your message and send it.\n\n_Your feedback helps us improve Tooley for teachers everywhere._",
-        "feedback_thanks": "🙏 *Thank you for your feedback!*\n\nYour input helps us make Tooley better for teachers everywhere.\n\nWhat would you like to do next?",
+        "feedback_prompt": "💬 <b>We'd love your feedback!</b>\n\nTell us:\n• What's working well?\n• What could be better?\n• What features would you like?\n\nJust type your message and send it.\n\n<i>Your feedback helps us improve Tooley for teachers everywhere.</i>",
+        "feedback_thanks": "🙏 <b>Thank you for your feedback!</b>\n\nYour input helps us make Tooley better for teachers everywhere.\n\nWhat would you like to do next?",
         
         # Errors
         "voice_not_configured": "Voice not configured. Please type.",
@@ -201,24 +216,24 @@ TRANSLATIONS = {
     
     "es": {
         # Language selection
-        "lang_prompt": "🌐 *Elige tu idioma:*",
+        "lang_prompt": "🌐 <b>Elige tu idioma:</b>",
         "lang_english": "🇬🇧 English",
         "lang_spanish": "🇪🇸 Español",
         "lang_changed": "✅ Idioma configurado: Español",
         
         # Welcome & Menu
-        "welcome": "👋 *¡Bienvenido a Tooley!*\n\nCreo planes de lección para docentes de todo el mundo.\n\n¿Qué te gustaría hacer?",
-        "welcome_back": "👋 *¡Bienvenido a Tooley!*\n\n¿Qué te gustaría hacer?",
+        "welcome": "👋 <b>¡Bienvenido a Tooley!</b>\n\nCreo planes de lección para docentes de todo el mundo.\n\n¿Qué te gustaría hacer?",
+        "welcome_back": "👋 <b>¡Bienvenido a Tooley!</b>\n\n¿Qué te gustaría hacer?",
         "quick_lesson": "⚡ Lección Rápida",
         "custom_lesson": "✨ Lección Personalizada",
         "help_tips": "❓ Ayuda",
         "change_language": "🌐 Idioma",
         
         # Quick Lesson
-        "quick_title": "⚡ *Lección Rápida*\n\n¡Elige una materia y generaré al instante!\n_Valores predeterminados: 9-11 años, 30 min, materiales básicos_",
+        "quick_title": "⚡ <b>Lección Rápida</b>\n\n¡Elige una materia y generaré al instante!\n<i>Valores predeterminados: 9-11 años, 30 min, materiales básicos</i>",
         
         # Subjects
-        "subject_prompt": "📚 *¡Creemos una lección!*\n\n¿Qué materia?",
+        "subject_prompt": "📚 <b>¡Creemos una lección!</b>\n\n¿Qué materia?",
         "subj_mathematics": "📐 Matemáticas",
         "subj_science": "🔬 Ciencias",
         "subj_reading": "📖 Lectura",
@@ -229,7 +244,7 @@ TRANSLATIONS = {
         "subject_other_prompt": "Escribe tu materia:",
         
         # Topic
-        "topic_prompt": "📝 *Tema*\n\nElige una sugerencia o escribe el tuyo:",
+        "topic_prompt": "📝 <b>Tema</b>\n\nElige una sugerencia o escribe el tuyo:",
         "topic_custom": "✏️ Escribir mi tema",
         "topic_type_prompt": "Escribe tu tema:",
         
@@ -241,7 +256,7 @@ TRANSLATIONS = {
         "min": "min",
         
         # Country
-        "country_prompt": "📍 *¿Dónde enseñas?*\n\n_Esto ayuda a adaptar la lección a tu currículo._",
+        "country_prompt": "📍 <b>¿Dónde enseñas?</b>\n\n<i>Esto ayuda a adaptar la lección a tu currículo.</i>",
         "country_global": "🌍 Global",
         
         # Materials
@@ -258,7 +273,7 @@ TRANSLATIONS = {
         "style_mixed": "⚖️ Mixto",
         
         # Format
-        "format_prompt": "📲 *Elige formato:*\n• _Chat_ = leer aquí\n• _PDF_ = imprimir\n• _HTML_ = navegador",
+        "format_prompt": "📲 <b>Elige formato:</b>\n• <i>Chat</i> = leer aquí\n• <i>PDF</i> = imprimir\n• <i>HTML</i> = navegador",
         "fmt_chat": "📱 Solo Chat",
         "fmt_pdf": "📄 Solo PDF",
         "fmt_html": "🌐 Solo HTML",
@@ -266,17 +281,17 @@ TRANSLATIONS = {
         "fmt_chathtml": "📱+🌐 Chat+HTML",
         
         # Generation
-        "generating": "⏳ *Generando tu lección...*\n\n_Esto puede tomar 15-30 segundos._",
-        "lesson_ready": "✅ *¡Tu lección está lista!*",
+        "generating": "⏳ <b>Generando tu lección...</b>\n\n<i>Esto puede tomar 15-30 segundos.</i>",
+        "lesson_ready": "✅ <b>¡Tu lección está lista!</b>",
         "generation_error": "❌ Error al generar la lección. Por favor, intenta de nuevo.",
         
         # Sharing
-        "share_prompt": "🌍 *¿Compartir con la comunidad?*\n\nTu lección aparecerá en tooley.app para que otros docentes la usen.",
+        "share_prompt": "🌍 <b>¿Compartir con la comunidad?</b>\n\nTu lección aparecerá en tooley.app para que otros docentes la usen.",
         "share_yes": "✅ Sí, compartir",
         "share_no": "🔒 Mantener privado",
-        "share_name_prompt": "🌍 *¡Gracias!*\n\n¿Tu nombre? (o 'skip' para anónimo)",
-        "share_success": "🎉 *¡Compartido!*\n\n📍 ¡En vivo en tooley.app!\n\n¿Qué sigue?",
-        "share_success_basic": "🎉 *¡Compartido!*\n\n¿Qué sigue?",
+        "share_name_prompt": "🌍 <b>¡Gracias!</b>\n\n¿Tu nombre? (o 'skip' para anónimo)",
+        "share_success": "🎉 <b>¡Compartido!</b>\n\n📍 ¡En vivo en tooley.app!\n\n¿Qué sigue?",
+        "share_success_basic": "🎉 <b>¡Compartido!</b>\n\n¿Qué sigue?",
         "saved_private": "👍 Guardado de forma privada.\n\n¿Qué sigue?",
         
         # Actions
@@ -285,7 +300,7 @@ TRANSLATIONS = {
         "back": "← Atrás",
         
         # Summary
-        "summary_header": "━━━━ *Tu Lección* ━━━━",
+        "summary_header": "━━━━ <b>Tu Lección</b> ━━━━",
         "summary_footer": "━━━━━━━━━━━━━━━━━━",
         "lbl_subject": "📚 Materia",
         "lbl_topic": "📝 Tema",
@@ -296,18 +311,18 @@ TRANSLATIONS = {
         "lbl_style": "🎯 Estilo",
         
         # Help
-        "help_text": "*Ayuda de Tooley*\n\n⚡ *Rápida* — Elige materia, yo hago el resto\n✨ *Personalizada* — Control total\n\n*Formatos:*\n📱 Chat = leer aquí\n📄 PDF = imprimir\n🌐 HTML = navegador\n\n*Compartir:* ¡Tus lecciones aparecen en tooley.app!",
-        "help_command": "*Ayuda de Tooley*\n\n/start - Menú principal\n/lesson - Nueva lección\n/subjects - Ver materias\n/language - Cambiar idioma\n/about - Acerca de Tooley\n/feedback - Enviar comentarios\n/help - Esta ayuda\n\n*Formatos:*\n📱 Chat = leer en Telegram\n📄 PDF = descargar para imprimir\n🌐 HTML = abrir en navegador",
+        "help_text": "<b>Ayuda de Tooley</b>\n\n⚡ <b>Rápida</b> — Elige materia, yo hago el resto\n✨ <b>Personalizada</b> — Control total\n\n<b>Formatos:</b>\n📱 Chat = leer aquí\n📄 PDF = imprimir\n🌐 HTML = navegador\n\n<b>Compartir:</b> ¡Tus lecciones aparecen en tooley.app!",
+        "help_command": "<b>Ayuda de Tooley</b>\n\n/start - Menú principal\n/lesson - Nueva lección\n/subjects - Ver materias\n/language - Cambiar idioma\n/about - Acerca de Tooley\n/feedback - Enviar comentarios\n/help - Esta ayuda\n\n<b>Formatos:</b>\n📱 Chat = leer en Telegram\n📄 PDF = descargar para imprimir\n🌐 HTML = abrir en navegador",
         
         # About
-        "about": "📚 *Acerca de Tooley*\n\nTooley es un generador gratuito de planes de lección impulsado por IA, creado para docentes en escuelas con recursos limitados.\n\n🎯 *Nuestra Misión*\nTodos los docentes merecen planes de lección de calidad, sin importar los recursos o la ubicación.\n\n✨ *Características*\n• Crea planes de lección completos en minutos\n• Contenido alineado al currículo\n• Múltiples materias disponibles\n• Descarga como PDF para uso sin conexión\n• Siempre gratis\n\n🌍 *Comunidad*\nÚnete a miles de docentes en todo el mundo usando Tooley.\n\n💛 Hecho con amor para docentes de todo el mundo.\n\n🔗 tooley.app",
+        "about": "📚 <b>Acerca de Tooley</b>\n\nTooley es un generador gratuito de planes de lección impulsado por IA, creado para docentes en escuelas con recursos limitados.\n\n🎯 <b>Nuestra Misión</b>\nTodos los docentes merecen planes de lección de calidad, sin importar los recursos o la ubicación.\n\n✨ <b>Características</b>\n• Crea planes de lección completos en minutos\n• Contenido alineado al currículo\n• Múltiples materias disponibles\n• Descarga como PDF para uso sin conexión\n• Siempre gratis\n\n🌍 <b>Comunidad</b>\nÚnete a miles de docentes en todo el mundo usando Tooley.\n\n💛 Hecho con amor para docentes de todo el mundo.\n\n🔗 tooley.app",
         
         # Subjects list
-        "subjects_list": "📚 *Materias Disponibles*\n\n📐 *Matemáticas* - Números, geometría, álgebra, resolución de problemas\n\n🔬 *Ciencias* - Biología, física, química, naturaleza\n\n📖 *Lectura* - Comprensión, fonética, literatura\n\n✏️ *Lenguaje* - Escritura, gramática, vocabulario\n\n🌍 *Estudios Sociales* - Historia, geografía, civismo\n\n🎨 *Arte y Música* - Expresión creativa, manualidades\n\n📝 *Otro* - ¡Cualquier tema que necesites!\n\n¿Listo? ¡Usa /lesson para crear un plan!",
+        "subjects_list": "📚 <b>Materias Disponibles</b>\n\n📐 <b>Matemáticas</b> - Números, geometría, álgebra, resolución de problemas\n\n🔬 <b>Ciencias</b> - Biología, física, química, naturaleza\n\n📖 <b>Lectura</b> - Comprensión, fonética, literatura\n\n✏️ <b>Lenguaje</b> - Escritura, gramática, vocabulario\n\n🌍 <b>Estudios Sociales</b> - Historia, geografía, civismo\n\n🎨 <b>Arte y Música</b> - Expresión creativa, manualidades\n\n📝 <b>Otro</b> - ¡Cualquier tema que necesites!\n\n¿Listo? ¡Usa /lesson para crear un plan!",
         
         # Feedback
-        "feedback_prompt": "💬 *¡Nos encantaría recibir tus comentarios!*\n\nCuéntanos:\n• ¿Qué está funcionando bien?\n• ¿Qué podría mejorar?\n• ¿Qué características te gustarían?\n\nSolo escribe tu mensaje y envíalo.\n\n_Tus comentarios nos ayudan a mejorar Tooley para docentes de todo el mundo._",
-        "feedback_thanks": "🙏 *¡Gracias por tus comentarios!*\n\nTu opinión nos ayuda a hacer Tooley mejor para docentes de todo el mundo.\n\n¿Qué te gustaría hacer ahora?",
+        "feedback_prompt": "💬 <b>¡Nos encantaría recibir tus comentarios!</b>\n\nCuéntanos:\n• ¿Qué está funcionando bien?\n• ¿Qué podría mejorar?\n• ¿Qué características te gustarían?\n\nSolo escribe tu mensaje y envíalo.\n\n<i>Tus comentarios nos ayudan a mejorar Tooley para docentes de todo el mundo.</i>",
+        "feedback_thanks": "🙏 <b>¡Gracias por tus comentarios!</b>\n\nTu opinión nos ayuda a hacer Tooley mejor para docentes de todo el mundo.\n\n¿Qué te gustaría hacer ahora?",
         
         # Errors
         "voice_not_configured": "Voz no configurada. Por favor, escribe.",
@@ -339,9 +354,15 @@ COUNTRIES_TRANSLATED = {
     ]
 }
 
+# Each language's table with English filled in for missing keys, so t() is one lookup
+_TRANSLATIONS_MERGED = {lang: {**TRANSLATIONS["en"], **table} for lang, table in TRANSLATIONS.items()}
+
 def t(key, lang="en"):
     """Get translated string"""
-    return TRANSLATIONS.get(lang, TRANSLATIONS["en"]).get(key, TRANSLATIONS["en"].get(key, key))
+    table = _TRANSLATIONS_MERGED.get(lang)
+    if table is None:
+        table = _TRANSLATIONS_MERGED["en"]
+    return table.get(key, key)
 
 def get_countries(lang="en"):
     """Get country list for language"""
@@ -422,16 +443,19 @@ TOPIC_POOLS = {
     }
 }
 
+# Flattened once at import rather than on every topic lookup
+TOPICS_BY_SUBJECT = {
+    lang: {
+        subject: tuple(topic for cat_topics in categories.values() for topic in cat_topics)
+        for subject, categories in pools.items()
+    }
+    for lang, pools in TOPIC_POOLS.items()
+}
+
+
 def get_topics_by_subject(lang="en"):
-    """Build flat topic list per subject for a language"""
-    pools = TOPIC_POOLS.get(lang, TOPIC_POOLS["en"])
-    result = {}
-    for subject, categories in pools.items():
-        all_topics = []
-        for cat_topics in categories.values():
-            all_topics.extend(cat_topics)
-        result[subject] = all_topics
-    return result
+    """Flat topic tuple per subject for a language"""
+    return TOPICS_BY_SUBJECT.get(lang, TOPICS_BY_SUBJECT["en"])
 
 
 def get_topic_categories(subject, lang="en"):
@@ -440,8 +464,7 @@ def get_topic_categories(subject, lang="en"):
 
 
 def get_random_topics(subject, count=8, lang="en"):
-    topics_by_subject = get_topics_by_subject(lang)
-    all_topics = topics_by_subject.get(subject, [])
+    all_topics = get_topics_by_subject(lang).get(subject, ())
     if len(all_topics) <= count:
         return all_topics
     return random.sample(all_topics, count)
@@ -453,45 +476,212 @@ def get_random_topics(subject, count=8, lang="en"):
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(levelname)s | %(message)s')
 logger = logging.getLogger(__name__)
+# httpx logs every request at INFO, which with long polling is a line every few seconds
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # ============================================================================
 # API CLIENTS
 # ============================================================================
 
-anthropic_client = Anthropic(api_key=CLAUDE_API_KEY) if CLAUDE_API_KEY else None
-groq_client = Groq(api_key=GROQ_API_KEY) if GROQ_API_KEY else None
+# Both SDKs would otherwise build their own HTTP/1.1 pools; one shared HTTP/2 client keeps
+# a warm multiplexed connection per API. The SDKs still set their own per-request timeouts.
+model_http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=32, keepalive_expiry=60.0),
+    timeout=httpx.Timeout(600.0, connect=5.0),
+)
+anthropic_client = AsyncAnthropic(api_key=CLAUDE_API_KEY, http_client=model_http_client) if CLAUDE_API_KEY else None
+groq_client = AsyncGroq(api_key=GROQ_API_KEY, http_client=model_http_client) if GROQ_API_KEY else None
 
 # ============================================================================
 # SESSION STORAGE
 # ============================================================================
 
-user_sessions = {}
+class State(IntEnum):
+    """Where a user is in the conversation; decides how their next text message is read"""
+    IDLE = 0
+    AWAITING_LANGUAGE = 1
+    AWAITING_FEEDBACK = 2
+    AWAITING_SUBJECT = 3
+    AWAITING_SUBJECT_TEXT = 4
+    AWAITING_TOPIC = 5
+    AWAITING_TOPIC_TEXT = 6
+    AWAITING_AGES = 7
+    AWAITING_DURATION = 8
+    AWAITING_COUNTRY = 9
+    AWAITING_MATERIALS = 10
+    AWAITING_STYLE = 11
+    AWAITING_FORMAT = 12
+    AWAITING_TEACHER_NAME = 13
+
+# Bounded so long uptimes don't accumulate every user ever seen; idle sessions expire
+MAX_SESSIONS = 100_000
+SESSION_TTL = 24 * 3600
+user_sessions = TTLCache(maxsize=MAX_SESSIONS, ttl=SESSION_TTL)
+
+@dataclass(slots=True)
+class Session:
+    state: State = State.IDLE
+    params: dict = field(default_factory=dict)
+    last_lesson: str | None = None
+    pending_share: bool = False
+    lang: str | None = None  # None = not yet selected
+    generated_from: int | None = None  # message whose button started the last generation
 
 def get_session(user_id):
-    if user_id not in user_sessions:
-        user_sessions[user_id] = {
-            'state': 'idle',
-            'params': {},
-            'last_lesson': None,
-            'pending_share': False,
-            'lang': None  # None = not yet selected
-        }
-    return user_sessions[user_id]
+    session = user_sessions.get(user_id)
+    if session is None:
+        session = Session()
+    # Re-inserting restarts the TTL, so only inactive users expire
+    user_sessions[user_id] = session
+    return session
 
 def reset_session(user_id):
-    lang = user_sessions.get(user_id, {}).get('lang')  # Preserve language
-    user_sessions[user_id] = {
-        'state': 'idle',
-        'params': {},
-        'last_lesson': None,
-        'pending_share': False,
-        'lang': lang
-    }
+    previous = user_sessions.get(user_id)
+    user_sessions[user_id] = Session(lang=previous.lang if previous else None)  # Preserve language
+
+# Sessions are written through to a store so a restart or deploy resumes conversations
+# mid-flow. The TTLCache stays in front of the store, so only a user's first update after a
+# restart reads it. SQLite is the default; with REDIS_URL set, sessions live in Redis instead,
+# which survives a host whose disk doesn't. Either way it's one bot process: polling allows a
+# single getUpdates consumer per token, and the per-user locks below are in-process only.
+class SessionStore:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL, updated REAL NOT NULL)")
+    
+    async def load(self, user_id):
+        row = self.db.execute(
+            "SELECT data FROM sessions WHERE user_id = ? AND updated >= ?",
+            (user_id, time.time() - SESSION_TTL)
+        ).fetchone()
+        return row[0] if row else None
+    
+    async def save(self, user_id, data):
+        self.db.execute(
+            "INSERT OR REPLACE INTO sessions (user_id, data, updated) VALUES (?, ?, ?)",
+            (user_id, data, time.time())
+        )
+    
+    async def delete(self, user_id):
+        self.db.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+    
+    def prune(self):
+        self.db.execute("DELETE FROM sessions WHERE updated < ?", (time.time() - SESSION_TTL,))
+    
+    async def close(self):
+        self.db.close()
+
+
+class RedisSessionStore:
+    def __init__(self, url):
+        import redis.asyncio as redis
+        self.redis = redis.from_url(url)
+    
+    async def load(self, user_id):
+        return await self.redis.get(f"tooley:sess:{user_id}")
+    
+    async def save(self, user_id, data):
+        await self.redis.set(f"tooley:sess:{user_id}", data, ex=SESSION_TTL)
+    
+    async def delete(self, user_id):
+        await self.redis.delete(f"tooley:sess:{user_id}")
+    
+    def prune(self):
+        pass  # Keys carry their own expiry
+    
+    async def close(self):
+        await self.redis.aclose()
+
+
+session_store = RedisSessionStore(REDIS_URL) if REDIS_URL else SessionStore(SESSION_DB)
+
+# Digest and time of each user's last stored session: unchanged sessions aren't rewritten,
+# except to refresh the stored copy's expiry well before it runs out
+_stored_sessions = TTLCache(maxsize=MAX_SESSIONS, ttl=SESSION_TTL)
+SESSION_REFRESH = SESSION_TTL / 4
+
+def _session_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+# TTLCache only evicts expired entries when it's written to, and SQLite rows are never read
+# again once stale, so both are swept on a timer instead of waiting for traffic
+SESSION_SWEEP_INTERVAL = 600
+
+def prune_sessions():
+    user_sessions.expire()
+    _stored_sessions.expire()
+    session_store.prune()
+
+prune_sessions()
+
+async def session_sweep_loop():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            prune_sessions()
+        except sqlite3.Error:
+            logger.exception("Session sweep error")
+
+async def load_session(user_id):
+    if user_id in user_sessions:
+        return
+    data = await session_store.load(user_id)
+    if not data:
+        return
+    try:
+        fields = orjson.loads(data)
+        fields['state'] = State(fields['state'])
+        session = Session(**fields)
+    except (orjson.JSONDecodeError, KeyError, ValueError, TypeError):
+        # A corrupt row, or one from before a Session field changed: start the user over
+        # rather than failing every update until the row expires
+        logger.exception(f"Discarding unreadable session for {user_id}")
+        await session_store.delete(user_id)
+        reset_session(user_id)
+        return
+    user_sessions[user_id] = session
+    _stored_sessions[user_id] = (_session_digest(data), time.time())
+
+async def save_session(user_id):
+    session = user_sessions.get(user_id)
+    if session is None:
+        return
+    data = orjson.dumps(session)
+    digest = _session_digest(data)
+    stored = _stored_sessions.get(user_id)
+    if stored and stored[0] == digest and time.time() - stored[1] < SESSION_REFRESH:
+        return
+    await session_store.save(user_id, data)
+    _stored_sessions[user_id] = (digest, time.time())
+
+# Updates are processed concurrently; a per-user lock keeps one user's updates in order
+# while other users proceed. Locks vanish once no handler holds or waits on them.
+_user_locks = weakref.WeakValueDictionary()
+
+def serialized(handler):
+    @wraps(handler)
+    async def wrapper(update, context):
+        if update.effective_user is None:
+            return await handler(update, context)
+        user_id = update.effective_user.id
+        lock = _user_locks.get(user_id)
+        if lock is None:
+            lock = _user_locks[user_id] = asyncio.Lock()
+        async with lock:
+            await load_session(user_id)
+            try:
+                return await handler(update, context)
+            finally:
+                await save_session(user_id)
+    return wrapper
 
 def get_lang(user_id):
     """Get user's language, default to English"""
     session = get_session(user_id)
-    return session.get('lang') or 'en'
+    return session.lang or 'en'
 
 # ============================================================================
 # LESSON GENERATION
@@ -503,30 +693,36 @@ Focus on active learning, student engagement, and real-world connections.
 Every section MUST have substantive content - never leave a section empty."""
 
 
+MATERIALS_DESC = MappingProxyType({
+    'none': 'NO MATERIALS - use only verbal activities, movement, imagination',
+    'basic': 'Basic materials - paper, pencils, blackboard',
+    'standard': 'Full classroom supplies available'
+})
+
+LANG_INSTRUCTIONS = MappingProxyType({
+    'en': "\n\nWrite in clear, simple English.",
+    'es': "\n\n**IMPORTANT: Generate this entire lesson plan in SPANISH (Español).**\n",
+})
+
 def build_lesson_prompt(params, lang="en"):
-    subject = params.get('subject', 'General')
-    topic = params.get('topic', 'Introduction')
-    ages = params.get('ages', '8-12')
-    duration = params.get('duration', '45')
-    country = params.get('country', 'Global')
-    materials = params.get('materials', 'basic')
-    style = params.get('style', 'mixed')
-    
-    materials_desc = {
-        'none': 'NO MATERIALS - use only verbal activities, movement, imagination',
-        'basic': 'Basic materials - paper, pencils, blackboard',
-        'standard': 'Full classroom supplies available'
-    }
-    
-    # Language instruction
-    if lang == "es":
-        lang_instruction = "\n\n**IMPORTANT: Generate this entire lesson plan in SPANISH (Español).**\n"
-    else:
-        lang_instruction = "\n\nWrite in clear, simple English."
+    return _build_lesson_prompt(
+        params.get('subject', 'General'),
+        params.get('topic', 'Introduction'),
+        params.get('ages', '8-12'),
+        params.get('duration', '45'),
+        params.get('country', 'Global'),
+        params.get('materials', 'basic'),
+        lang,
+    )
+
+
+@lru_cache(maxsize=512)
+def _build_lesson_prompt(subject, topic, ages, duration, country, materials, lang):
+    lang_instruction = LANG_INSTRUCTIONS.get(lang, LANG_INSTRUCTIONS['en'])
     
     return f"""Create a {duration}-minute lesson plan on **{topic}** for {subject}.
 Students are ages {ages}. Location: {country}
-Materials: {materials_desc.get(materials, materials)}
+Materials: {MATERIALS_DESC.get(materials, materials)}
 {lang_instruction}
 
 Use numbered steps and bullet points for clarity.
@@ -567,45 +763,167 @@ Structure with these sections (all must have content):
 CRITICAL: Every section must have real content."""
 
 
-def generate_lesson(params, lang="en"):
+# Custom lessons get Sonnet; one-tap quick lessons trade some depth for Haiku's speed
+LESSON_MODEL = "claude-sonnet-4-20250514"
+QUICK_LESSON_MODEL = os.environ.get("QUICK_LESSON_MODEL", "claude-3-5-haiku-20241022")
+
+# Same model and prompt -> same lesson; keyed on their hash so any param that changes it misses.
+# Entries expire after a day so a re-request eventually gets a freshly generated lesson.
+LESSON_CACHE_TTL = 24 * 3600
+LESSON_CACHE = TTLCache(maxsize=1024, ttl=LESSON_CACHE_TTL)
+
+# Generations still running, by the same key; a second caller for the same prompt joins the
+# running call instead of starting another. Their streamed text so far is in _lesson_partial.
+_lesson_inflight = {}
+_lesson_partial = {}
+# Telegram allows about one edit per second per chat
+PREVIEW_INTERVAL = 1.5
+
+async def generate_lesson(params, lang="en", preview=None, model=LESSON_MODEL):
     user_prompt = build_lesson_prompt(params, lang)
-    logger.info(f"Generating lesson: {params.get('subject')} - {params.get('topic')} (lang={lang})")
-    
-    response = anthropic_client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=3000,
-        system=LESSON_SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": user_prompt}]
-    )
-    return response.content[0].text
+    key = hashlib.sha256(f"{model}\n{user_prompt}".encode()).digest()
+    cached = LESSON_CACHE.get(key)
+    if cached is not None:
+        logger.info(f"Lesson cache hit: {params.get('subject')} - {params.get('topic')} (lang={lang})")
+        return cached
+    inflight = _lesson_inflight.get(key)
+    if inflight is None:
+        logger.info(f"Generating lesson: {params.get('subject')} - {params.get('topic')} (lang={lang})")
+        inflight = _lesson_inflight[key] = asyncio.ensure_future(_create_lesson(user_prompt, key, model))
+        inflight.add_done_callback(lambda _: _lesson_inflight.pop(key, None))
+    
+    # Whoever waits with a preview callback gets the text streamed so far every
+    # PREVIEW_INTERVAL seconds, whether they started the call or joined it
+    shown = 0
+    while preview is not None and not inflight.done():
+        await asyncio.wait({inflight}, timeout=PREVIEW_INTERVAL)
+        parts = _lesson_partial.get(key)
+        if parts and not inflight.done() and len(parts) > shown:
+            shown = len(parts)
+            await preview("".join(parts))
+    # Shielded so one waiter giving up doesn't cancel the call for the others
+    return await asyncio.shield(inflight)
+
+
+async def _create_lesson(user_prompt, key, model):
+    parts = _lesson_partial[key] = []
+    try:
+        async with anthropic_client.messages.stream(
+            model=model,
+            max_tokens=3000,
+            system=LESSON_SYSTEM_PROMPT,
+            messages=[{"role": "user", "content": user_prompt}]
+        ) as stream:
+            async for text in stream.text_stream:
+                parts.append(text)
+            usage = (await stream.get_final_message()).usage
+        logger.info(f"Lesson tokens: in={usage.input_tokens} out={usage.output_tokens}")
+    finally:
+        _lesson_partial.pop(key, None)
+    lesson = "".join(parts)
+    LESSON_CACHE[key] = lesson
+    return lesson
+
+
+# The format choice doesn't change the prompt, so the lesson can start generating as soon as
+# the style is picked; the format step then joins the running call through _lesson_inflight
+_prefetches = set()
+
+def prefetch_lesson(params, lang="en"):
+    task = asyncio.create_task(generate_lesson(dict(params), lang))
+    _prefetches.add(task)
+    task.add_done_callback(_prefetch_done)
+
+def _prefetch_done(task):
+    _prefetches.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Lesson prefetch failed: {task.exception()}")
 
 
 # ============================================================================
 # PDF GENERATION
 # ============================================================================
 
+class _NonAsciiFill(dict):
+    """str.translate table that sends any unlisted non-ASCII code point to `fill`"""
+    def __init__(self, table, fill):
+        super().__init__(table)
+        self.fill = fill
+    
+    def __missing__(self, key):
+        return self.fill if key >= 128 else key
+
+
+# Symbol, emoji and accent replacements for LessonPDF.safe; any other non-ASCII is dropped in
+# the same translate pass
+_SAFE_TABLE = _NonAsciiFill(str.maketrans({'→': '->', '←': '<-', '•': '*', '–': '-', '—': '-',
+    '\u201c': '"', '\u201d': '"', '\u2018': "'", '\u2019': "'", '…': '...',
+    '✓': '[x]', '✗': '[ ]', '★': '*', '☆': '*', '●': '*', '○': 'o',
+    '▪': '-', '▸': '>', '◦': 'o', '✔': '[x]', '✘': '[ ]',
+    '📚': '', '📖': '', '✏': '', '🎯': '', '💡': '', '⏱': '', '👥': '',
+    '🔹': '-', '🔸': '-', '📝': '', '🌟': '*', '⭐': '*',
+    'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u',
+    'Á': 'A', 'É': 'E', 'Í': 'I', 'Ó': 'O', 'Ú': 'U',
+    'ñ': 'n', 'Ñ': 'N', '¿': '?', '¡': '!'}), None)
+
+
+# Markdown line kinds shared by the PDF and HTML renderers, matched once per line; the
+# matching group's name (m.lastgroup) is the kind and its text is the line's content
+_LINE_RE = re.compile(
+    r'## (?P<h2>.*)'
+    r'|# (?P<h1>.*)'
+    r'|\*\*(?P<bold>.*)\*\*$'
+    r'|[-*] (?P<bullet>.*)'
+    r'|(?P<numbered>\d[.):].+)'
+)
+
+# Export labels for lesson specs; the PDF is English-only, the HTML follows the user's language
+_SPEC_LABELS = {
+    "en": {"subject": "Subject", "topic": "Topic", "ages": "Ages", "duration": "Duration", 
+           "location": "Location", "materials": "Materials", "style": "Style", "minutes": "minutes"},
+    "es": {"subject": "Materia", "topic": "Tema", "ages": "Edades", "duration": "Duración",
+           "location": "Ubicación", "materials": "Materiales", "style": "Estilo", "minutes": "minutos"}
+}
+_MATERIAL_LABELS = {
+    "en": {'none': 'No materials', 'basic': 'Basic supplies', 'standard': 'Full classroom'},
+    "es": {'none': 'Sin materiales', 'basic': 'Materiales básicos', 'standard': 'Aula completa'}
+}
+_STYLE_LABELS = {
+    "en": {'interactive': 'Interactive', 'structured': 'Structured', 'storytelling': 'Story-based', 'mixed': 'Mixed'},
+    "es": {'interactive': 'Interactivo', 'structured': 'Estructurado', 'storytelling': 'Narrativo', 'mixed': 'Mixto'}
+}
+
+def draw_brand(pdf):
+    """Amber bar, 'tooley' logo text and the site URL across the top of the page"""
+    pdf.set_fill_color(217, 119, 6)
+    pdf.rect(10, 10, 4, 14, 'F')
+    pdf.set_xy(18, 10)
+    pdf.set_font('Helvetica', 'B', 22)
+    pdf.set_text_color(217, 119, 6)
+    pdf.cell(40, 14, 'tooley', align='L')
+    pdf.set_xy(150, 14)
+    pdf.set_font('Helvetica', '', 10)
+    pdf.set_text_color(100, 116, 139)
+    pdf.cell(50, 10, 'tooley.app', align='R')
+
+
+# write_content text styles: (font style, size, RGB text color)
+_PDF_BODY = ('', 10, (15, 23, 42))
+_PDF_H1 = ('B', 14, (15, 23, 42))
+_PDF_H2 = ('B', 12, (217, 119, 6))
+
+
 class LessonPDF(FPDF):
     def __init__(self, params=None, lang="en"):
         super().__init__()
         self.params = params or {}
         self.lang = lang
+        self._text_style = None
         self.set_auto_page_break(auto=True, margin=25)
         self.add_page()
     
     def header(self):
-        # Amber bar
-        self.set_fill_color(217, 119, 6)
-        self.rect(10, 10, 4, 14, 'F')
-        # Logo text in amber
-        self.set_xy(18, 10)
-        self.set_font('Helvetica', 'B', 22)
-        self.set_text_color(217, 119, 6)
-        self.cell(40, 14, 'tooley', align='L')
-        # URL on right
-        self.set_xy(150, 14)
-        self.set_font('Helvetica', '', 10)
-        self.set_text_color(100, 116, 139)
-        self.cell(50, 10, 'tooley.app', align='R')
+        draw_brand(self)
         self.ln(18)
     
     def footer(self):
@@ -623,38 +941,26 @@ class LessonPDF(FPDF):
         if not text:
             return ""
         text = str(text).replace('**', '')
-        # Common replacements
-        replacements = {'→': '->', '←': '<-', '•': '*', '–': '-', '—': '-',
-            '"': '"', '"': '"', ''': "'", ''': "'", '…': '...',
-            '✓': '[x]', '✗': '[ ]', '★': '*', '☆': '*', '●': '*', '○': 'o',
-            '▪': '-', '▸': '>', '◦': 'o', '✔': '[x]', '✘': '[ ]',
-            '📚': '', '📖': '', '✏': '', '🎯': '', '💡': '', '⏱': '', '👥': '',
-            '🔹': '-', '🔸': '-', '📝': '', '🌟': '*', '⭐': '*',
-            'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u',
-            'Á': 'A', 'É': 'E', 'Í': 'I', 'Ó': 'O', 'Ú': 'U',
-            'ñ': 'n', 'Ñ': 'N', '¿': '?', '¡': '!'}
-        for old, new in replacements.items():
-            text = text.replace(old, new)
-        # Strip any remaining non-ASCII
-        return ''.join(c if ord(c) < 128 else '' for c in text)
+        if text.isascii():
+            return text
+        return text.translate(_SAFE_TABLE)
     
     def write_specs(self, params):
         self.set_fill_color(250, 250, 245)
         self.set_draw_color(15, 23, 42)
         self.set_line_width(0.4)
         
+        lbl = _SPEC_LABELS["en"]
         specs = []
-        if params.get('subject'): specs.append(('Subject', params['subject']))
-        if params.get('topic'): specs.append(('Topic', params['topic']))
-        if params.get('ages'): specs.append(('Ages', params['ages']))
-        if params.get('duration'): specs.append(('Duration', f"{params['duration']} min"))
-        if params.get('country'): specs.append(('Location', params['country']))
+        if params.get('subject'): specs.append((lbl['subject'], params['subject']))
+        if params.get('topic'): specs.append((lbl['topic'], params['topic']))
+        if params.get('ages'): specs.append((lbl['ages'], params['ages']))
+        if params.get('duration'): specs.append((lbl['duration'], f"{params['duration']} min"))
+        if params.get('country'): specs.append((lbl['location'], params['country']))
         if params.get('materials'):
-            m = {'none': 'No materials', 'basic': 'Basic supplies', 'standard': 'Full classroom'}
-            specs.append(('Materials', m.get(params['materials'], params['materials'])))
+            specs.append((lbl['materials'], _MATERIAL_LABELS["en"].get(params['materials'], params['materials'])))
         if params.get('style'):
-            s = {'interactive': 'Interactive', 'structured': 'Structured', 'storytelling': 'Story-based', 'mixed': 'Mixed'}
-            specs.append(('Style', s.get(params['style'], params['style'])))
+            specs.append((lbl['style'], _STYLE_LABELS["en"].get(params['style'], params['style'])))
         
         box_h = 12 + len(specs) * 6
         y_start = self.get_y()
@@ -676,44 +982,53 @@ class LessonPDF(FPDF):
         
         self.set_y(y_start + box_h + 8)
     
-    def write_content(self, content):
-        self.set_font('Helvetica', '', 10)
-        self.set_text_color(15, 23, 42)
+    def use_style(self, style):
+        # Lines switch style only when it differs from the previous line's, so a heading
+        # doesn't pay for restoring the body style when another heading follows
+        if style is self._text_style:
+            return
+        self._text_style = style
+        font_style, size, color = style
+        self.set_font('Helvetica', font_style, size)
+        self.set_text_color(*color)
+    
+    def write_content(self, lines):
+        self.use_style(_PDF_BODY)
         
-        for line in content.split('\n'):
+        for line in lines:
             try:
-                orig = line
                 line = line.strip()
                 
                 if not line:
                     self.ln(3)
                     continue
                 
-                safe = self.safe(line)
-                if not safe.strip():
+                safe = self.safe(line).strip()
+                if not safe:
                     continue
                 
-                if safe.startswith('## '):
+                m = _LINE_RE.match(safe)
+                kind = m.lastgroup if m else None
+                if kind == 'h2':
                     self.ln(5)
-                    self.set_font('Helvetica', 'B', 12)
-                    self.set_text_color(217, 119, 6)
-                    self.multi_cell(0, 6, safe[3:])
-                    self.set_font('Helvetica', '', 10)
-                    self.set_text_color(15, 23, 42)
+                    self.use_style(_PDF_H2)
+                    self.multi_cell(0, 6, m['h2'])
                     self.ln(2)
-                elif safe.startswith('# '):
+                elif kind == 'h1':
                     self.ln(5)
-                    self.set_font('Helvetica', 'B', 14)
-                    self.multi_cell(0, 7, safe[2:])
-                    self.set_font('Helvetica', '', 10)
+                    self.use_style(_PDF_H1)
+                    self.multi_cell(0, 7, m['h1'])
                     self.ln(2)
-                elif safe.startswith('- ') or safe.startswith('* '):
+                elif kind == 'bullet':
+                    self.use_style(_PDF_BODY)
                     self.set_x(15)
                     self.multi_cell(0, 5, f"  {safe}")
-                elif len(safe) > 2 and safe[0].isdigit() and safe[1] in '.):':
+                elif kind == 'numbered':
+                    self.use_style(_PDF_BODY)
                     self.set_x(15)
                     self.multi_cell(0, 5, safe)
                 else:
+                    self.use_style(_PDF_BODY)
                     self.multi_cell(0, 5, safe)
                     self.ln(1)
             except Exception as e:
@@ -721,224 +1036,137 @@ class LessonPDF(FPDF):
                 continue
 
 
-def create_lesson_pdf(content, params, lang="en"):
+# Fallback PDF attempts: symbols become '-' and other non-ASCII is dropped, or everything becomes a space
+_SIMPLE_PDF_TABLE = _NonAsciiFill(str.maketrans(dict.fromkeys('→←•–—\u201c\u201d\u2018\u2019…✓✗★☆●○', '-')), None)
+_MINIMAL_PDF_TABLE = _NonAsciiFill({}, ' ')
+
+
+def _full_pdf(lines, params, lang):
+    pdf = LessonPDF(params, lang)
+    pdf.write_specs(params)
+    pdf.write_content(lines)
+    return pdf
+
+
+def _simple_pdf(lines, params, lang):
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_page()
+    
+    # Simple header
+    pdf.set_font('Helvetica', 'B', 16)
+    pdf.cell(0, 10, 'Tooley Lesson Plan', ln=True)
+    pdf.set_font('Helvetica', '', 10)
+    pdf.ln(5)
+    
+    for line in lines:
+        line = line.replace('**', '').translate(_SIMPLE_PDF_TABLE).strip()
+        if line:
+            try:
+                pdf.multi_cell(0, 5, line[:500])
+            except:
+                pass
+        else:
+            pdf.ln(3)
+    return pdf
+
+
+def _minimal_pdf(lines, params, lang):
+    pdf = FPDF()
+    pdf.add_page()
+    draw_brand(pdf)
+    pdf.ln(25)
+    
+    pdf.set_font('Helvetica', '', 10)
+    pdf.set_text_color(0, 0, 0)
+    
+    for line in lines[:200]:
+        line = line.translate(_MINIMAL_PDF_TABLE).replace('**', '').strip()[:200]
+        if line:
+            try:
+                pdf.multi_cell(0, 5, line)
+            except:
+                pass
+        pdf.ln(2)
+    return pdf
+
+
+# Each layout is only tried if the one before it raised or came out implausibly small;
+# the last one's output is returned whatever its size
+PDF_LAYOUTS = (("full", _full_pdf), ("simple", _simple_pdf), ("minimal", _minimal_pdf))
+
+
+def create_lesson_pdf(lines, params, lang="en"):
+    """Render a lesson, given as its list of lines, to PDF bytes (None if every layout fails)"""
     logger.info("Creating PDF...")
     
-    # Attempt 1: Full formatting
-    try:
-        pdf = LessonPDF(params, lang)
-        pdf.write_specs(params)
-        pdf.write_content(content)
-        buffer = BytesIO()
-        pdf.output(buffer)
-        buffer.seek(0)
-        data = buffer.getvalue()
-        logger.info(f"PDF created: {len(data)} bytes")
-        if len(data) > 500:
-            return data
-    except Exception as e:
-        logger.error(f"PDF attempt 1 failed: {e}")
-    
-    # Attempt 2: Simpler formatting
-    try:
-        pdf = FPDF()
-        pdf.set_auto_page_break(auto=True, margin=15)
-        pdf.add_page()
-        pdf.set_font('Helvetica', '', 10)
-        
-        # Simple header
-        pdf.set_font('Helvetica', 'B', 16)
-        pdf.cell(0, 10, 'Tooley Lesson Plan', ln=True)
-        pdf.set_font('Helvetica', '', 10)
-        pdf.ln(5)
-        
-        # Safe content
-        safe_content = content.replace('**', '')
-        for char in ['→', '←', '•', '–', '—', '"', '"', ''', ''', '…', '✓', '✗', '★', '☆', '●', '○']:
-            safe_content = safe_content.replace(char, '-')
-        safe_content = ''.join(c if ord(c) < 128 else '' for c in safe_content)
-        
-        for line in safe_content.split('\n'):
-            line = line.strip()
-            if line:
-                try:
-                    pdf.multi_cell(0, 5, line[:500])
-                except:
-                    pass
-            else:
-                pdf.ln(3)
-        
-        buffer = BytesIO()
-        pdf.output(buffer)
-        buffer.seek(0)
-        data = buffer.getvalue()
-        logger.info(f"PDF (simple) created: {len(data)} bytes")
-        if len(data) > 500:
-            return data
-    except Exception as e:
-        logger.error(f"PDF attempt 2 failed: {e}")
-    
-    # Attempt 3: Minimal with branding
-    try:
-        pdf = FPDF()
-        pdf.add_page()
-        
-        # Amber bar + logo
-        pdf.set_fill_color(217, 119, 6)
-        pdf.rect(10, 10, 4, 14, 'F')
-        pdf.set_xy(18, 10)
-        pdf.set_font('Helvetica', 'B', 22)
-        pdf.set_text_color(217, 119, 6)
-        pdf.cell(40, 14, 'tooley', align='L')
-        pdf.set_xy(150, 14)
-        pdf.set_font('Helvetica', '', 10)
-        pdf.set_text_color(100, 116, 139)
-        pdf.cell(50, 10, 'tooley.app', align='R')
-        pdf.ln(25)
-        
-        pdf.set_font('Helvetica', '', 10)
-        pdf.set_text_color(0, 0, 0)
-        
-        ascii_content = ''.join(c if ord(c) < 128 else ' ' for c in content)
-        ascii_content = ascii_content.replace('**', '')
-        
-        for line in ascii_content.split('\n')[:200]:
-            line = line.strip()[:200]
-            if line:
-                try:
-                    pdf.multi_cell(0, 5, line)
-                except:
-                    pass
-            pdf.ln(2)
-        
-        buffer = BytesIO()
-        pdf.output(buffer)
-        buffer.seek(0)
-        return buffer.getvalue()
-    except Exception as e:
-        logger.error(f"PDF attempt 3 failed: {e}")
-        return None
+    for name, build in PDF_LAYOUTS:
+        try:
+            data = bytes(build(lines, params, lang).output())
+            logger.info(f"PDF ({name}) created: {len(data)} bytes")
+            if len(data) > 500 or build is _minimal_pdf:
+                return data
+        except Exception as e:
+            logger.error(f"PDF {name} layout failed: {e}")
+    return None
 
 
+_SUBJECT_ABBREV = MappingProxyType({
+    'Mathematics': 'math', 'Language': 'lang', 'Science': 'science',
+    'Reading': 'reading', 'Social Studies': 'social', 'Art': 'art',
+})
+
 def generate_lesson_filename(params):
-    parts = ['tooley']
-    subject = params.get('subject', 'lesson')
-    abbrev = {'Mathematics': 'math', 'Language': 'lang', 'Science': 'science',
-        'Reading': 'reading', 'Social Studies': 'social', 'Art': 'art'}
-    parts.append(abbrev.get(subject, subject[:6].lower()))
-    topic = params.get('topic', 'lesson')
-    topic_clean = ''.join(c for c in topic.lower().replace(' ', '-')[:20] if c.isalnum() or c == '-')
-    parts.append(topic_clean)
-    if params.get('ages'):
-        parts.append(f"ages{params['ages'].replace('-', 'to')}")
-    if params.get('duration'):
-        parts.append(f"{params['duration']}min")
+    return _lesson_filename(
+        params.get('subject', 'lesson'),
+        params.get('topic', 'lesson'),
+        params.get('ages'),
+        params.get('duration'),
+    )
+
+
+@lru_cache(maxsize=2048)
+def _lesson_filename(subject, topic, ages, duration):
+    parts = ['tooley', _SUBJECT_ABBREV.get(subject, subject[:6].lower())]
+    parts.append(''.join(c for c in topic.lower().replace(' ', '-')[:20] if c.isalnum() or c == '-'))
+    if ages:
+        parts.append(f"ages{ages.replace('-', 'to')}")
+    if duration:
+        parts.append(f"{duration}min")
     return '_'.join(parts)
 
 
+# fpdf2 and the HTML builder are pure Python; run them off the event loop so other
+# users' updates keep flowing while a lesson renders
+RENDER_WORKERS = 8
+_render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+
+# PDF layout is the CPU-heavy part; it gets its own small pool so a burst of PDFs can't
+# occupy every render thread and hold up the cheap HTML builds behind it
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", 2))
+_pdf_pool = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix="pdf")
+
+async def render(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_render_pool, fn, *args)
+
+async def render_pdf(lines, params, lang):
+    return await asyncio.get_running_loop().run_in_executor(_pdf_pool, create_lesson_pdf, lines, params, lang)
+
+
 # ============================================================================
 # HTML GENERATION
 # ============================================================================
 
-def create_lesson_html(content, params, lang="en"):
-    # Translated labels
-    labels = {
-        "en": {"subject": "Subject", "topic": "Topic", "ages": "Ages", "duration": "Duration", 
-               "location": "Location", "materials": "Materials", "style": "Style", "minutes": "minutes"},
-        "es": {"subject": "Materia", "topic": "Tema", "ages": "Edades", "duration": "Duración",
-               "location": "Ubicación", "materials": "Materiales", "style": "Estilo", "minutes": "minutos"}
-    }
-    lbl = labels.get(lang, labels["en"])
-    
-    # Materials translations
-    mat_trans = {
-        "en": {'none': 'No materials', 'basic': 'Basic supplies', 'standard': 'Full classroom'},
-        "es": {'none': 'Sin materiales', 'basic': 'Materiales básicos', 'standard': 'Aula completa'}
-    }
-    mat = mat_trans.get(lang, mat_trans["en"])
-    
-    # Style translations
-    style_trans = {
-        "en": {'interactive': 'Interactive', 'structured': 'Structured', 'storytelling': 'Story-based', 'mixed': 'Mixed'},
-        "es": {'interactive': 'Interactivo', 'structured': 'Estructurado', 'storytelling': 'Narrativo', 'mixed': 'Mixto'}
-    }
-    sty = style_trans.get(lang, style_trans["en"])
-    
-    specs_html = ""
-    if params.get('subject'):
-        specs_html += f"<div class='spec'><span class='label'>{lbl['subject']}:</span> {params['subject']}</div>"
-    if params.get('topic'):
-        specs_html += f"<div class='spec'><span class='label'>{lbl['topic']}:</span> {params['topic']}</div>"
-    if params.get('ages'):
-        specs_html += f"<div class='spec'><span class='label'>{lbl['ages']}:</span> {params['ages']}</div>"
-    if params.get('duration'):
-        specs_html += f"<div class='spec'><span class='label'>{lbl['duration']}:</span> {params['duration']} {lbl['minutes']}</div>"
-    if params.get('country'):
-        specs_html += f"<div class='spec'><span class='label'>{lbl['location']}:</span> {params['country']}</div>"
-    if params.get('materials'):
-        specs_html += f"<div class='spec'><span class='label'>{lbl['materials']}:</span> {mat.get(params['materials'], params['materials'])}</div>"
-    if params.get('style'):
-        specs_html += f"<div class='spec'><span class='label'>{lbl['style']}:</span> {sty.get(params['style'], params['style'])}</div>"
-    
-    content_html = ""
-    in_list = False
-    
-    for line in content.split('\n'):
-        stripped = line.strip()
-        
-        if not stripped:
-            if in_list:
-                content_html += "</ul>"
-                in_list = False
-            content_html += "<br>"
-            continue
-        
-        if line.startswith('## '):
-            if in_list:
-                content_html += "</ul>"
-                in_list = False
-            content_html += f"<h2>{stripped[3:]}</h2>"
-            continue
-        
-        if stripped.startswith('**') and stripped.endswith('**'):
-            if in_list:
-                content_html += "</ul>"
-                in_list = False
-            content_html += f"<p class='bold'>{stripped[2:-2]}</p>"
-            continue
-        
-        if stripped.startswith('- ') or stripped.startswith('* '):
-            if not in_list:
-                content_html += "<ul>"
-                in_list = True
-            content_html += f"<li>{stripped[2:]}</li>"
-            continue
-        
-        if len(stripped) > 2 and stripped[0].isdigit() and stripped[1] in '.):':
-            if in_list:
-                content_html += "</ul>"
-                in_list = False
-            content_html += f"<p class='numbered'>{stripped}</p>"
-            continue
-        
-        if in_list:
-            content_html += "</ul>"
-            in_list = False
-        
-        processed = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', stripped)
-        content_html += f"<p>{processed}</p>"
-    
-    if in_list:
-        content_html += "</ul>"
-    
-    footer_text = t('pdf_footer', lang)
-    
-    html = f'''<!DOCTYPE html>
+# **bold** spans inside a paragraph; whole-line bold is already captured by _LINE_RE
+_INLINE_BOLD_RE = re.compile(r'\*\*(.+?)\*\*')
+
+# Page shell for create_lesson_html, filled with str.format (CSS braces are doubled)
+_HTML_SHELL = '''<!DOCTYPE html>
 <html lang="{lang}">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Lesson Plan - {params.get('topic', 'Tooley')}</title>
+    <title>Lesson Plan - {title}</title>
     <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700&display=swap" rel="stylesheet">
     <style>
         * {{ margin: 0; padding: 0; box-sizing: border-box; }}
@@ -969,7 +1197,7 @@ def create_lesson_html(content, params, lang="en"):
         <span class="tagline"><a href="https://tooley.app">tooley.app</a></span>
     </div>
     <div class="specs-box">
-        <div class="specs-title">{t('pdf_specs_title', lang)}</div>
+        <div class="specs-title">{specs_title}</div>
         {specs_html}
     </div>
     <div class="content">
@@ -980,35 +1208,116 @@ def create_lesson_html(content, params, lang="en"):
     </div>
 </body>
 </html>'''
-    return html
+
+
+def create_lesson_html(lines, params, lang="en"):
+    lbl = _SPEC_LABELS.get(lang, _SPEC_LABELS["en"])
+    mat = _MATERIAL_LABELS.get(lang, _MATERIAL_LABELS["en"])
+    sty = _STYLE_LABELS.get(lang, _STYLE_LABELS["en"])
+    
+    specs_parts = []
+    if params.get('subject'):
+        specs_parts.append(f"<div class='spec'><span class='label'>{lbl['subject']}:</span> {params['subject']}</div>")
+    if params.get('topic'):
+        specs_parts.append(f"<div class='spec'><span class='label'>{lbl['topic']}:</span> {params['topic']}</div>")
+    if params.get('ages'):
+        specs_parts.append(f"<div class='spec'><span class='label'>{lbl['ages']}:</span> {params['ages']}</div>")
+    if params.get('duration'):
+        specs_parts.append(f"<div class='spec'><span class='label'>{lbl['duration']}:</span> {params['duration']} {lbl['minutes']}</div>")
+    if params.get('country'):
+        specs_parts.append(f"<div class='spec'><span class='label'>{lbl['location']}:</span> {params['country']}</div>")
+    if params.get('materials'):
+        specs_parts.append(f"<div class='spec'><span class='label'>{lbl['materials']}:</span> {mat.get(params['materials'], params['materials'])}</div>")
+    if params.get('style'):
+        specs_parts.append(f"<div class='spec'><span class='label'>{lbl['style']}:</span> {sty.get(params['style'], params['style'])}</div>")
+    specs_html = "".join(specs_parts)
+    
+    content_parts = []
+    in_list = False
+    
+    for line in lines:
+        stripped = line.strip()
+        
+        if not stripped:
+            if in_list:
+                content_parts.append("</ul>")
+                in_list = False
+            content_parts.append("<br>")
+            continue
+        
+        m = _LINE_RE.match(stripped)
+        kind = m.lastgroup if m else None
+        
+        if kind == 'bullet':
+            if not in_list:
+                content_parts.append("<ul>")
+                in_list = True
+            content_parts.append(f"<li>{m['bullet']}</li>")
+            continue
+        
+        if in_list:
+            content_parts.append("</ul>")
+            in_list = False
+        
+        if kind == 'h2':
+            content_parts.append(f"<h2>{m['h2']}</h2>")
+            continue
+        
+        if kind == 'bold':
+            content_parts.append(f"<p class='bold'>{m['bold']}</p>")
+            continue
+        
+        if kind == 'numbered':
+            content_parts.append(f"<p class='numbered'>{stripped}</p>")
+            continue
+        
+        if '**' in stripped:
+            stripped = _INLINE_BOLD_RE.sub(r'<strong>\1</strong>', stripped)
+        content_parts.append(f"<p>{stripped}</p>")
+    
+    if in_list:
+        content_parts.append("</ul>")
+    content_html = "".join(content_parts)
+    
+    return _HTML_SHELL.format(
+        lang=lang,
+        title=params.get('topic', 'Tooley'),
+        specs_title=t('pdf_specs_title', lang),
+        specs_html=specs_html,
+        content_html=content_html,
+        footer_text=t('pdf_footer', lang)
+    )
 
 
 # ============================================================================
 # HELPERS
 # ============================================================================
 
+# Emoji option labels for the selection summary, as shown on the materials/style buttons
+_MATERIAL_SUMMARY = {lang: {m: t(f'mat_{m}', lang) for m in ('none', 'basic', 'standard')} for lang in TRANSLATIONS}
+_STYLE_SUMMARY = {lang: {s: t(f'style_{s}', lang) for s in ('interactive', 'structured', 'storytelling', 'mixed')}
+                  for lang in TRANSLATIONS}
+
 def build_selection_summary(params, lang="en"):
     lines = [t('summary_header', lang)]
-    if params.get('subject'): lines.append(f"{t('lbl_subject', lang)}: {params['subject']}")
-    if params.get('topic'): lines.append(f"{t('lbl_topic', lang)}: {params['topic']}")
+    # Subject, topic and country can be typed by the user, so they're escaped for HTML parse mode
+    if params.get('subject'): lines.append(f"{t('lbl_subject', lang)}: {escape(params['subject'], quote=False)}")
+    if params.get('topic'): lines.append(f"{t('lbl_topic', lang)}: {escape(params['topic'], quote=False)}")
     if params.get('ages'): lines.append(f"{t('lbl_ages', lang)}: {params['ages']}")
     if params.get('duration'): lines.append(f"{t('lbl_duration', lang)}: {params['duration']} {t('min', lang)}")
-    if params.get('country'): lines.append(f"{t('lbl_location', lang)}: {params['country']}")
+    if params.get('country'): lines.append(f"{t('lbl_location', lang)}: {escape(params['country'], quote=False)}")
     if params.get('materials'):
-        m = {'none': t('mat_none', lang), 'basic': t('mat_basic', lang), 'standard': t('mat_standard', lang)}
+        m = _MATERIAL_SUMMARY.get(lang, _MATERIAL_SUMMARY["en"])
         lines.append(f"{t('lbl_materials', lang)}: {m.get(params['materials'], params['materials'])}")
     if params.get('style'):
-        s = {'interactive': t('style_interactive', lang), 'structured': t('style_structured', lang),
-             'storytelling': t('style_storytelling', lang), 'mixed': t('style_mixed', lang)}
+        s = _STYLE_SUMMARY.get(lang, _STYLE_SUMMARY["en"])
         lines.append(f"{t('lbl_style', lang)}: {s.get(params['style'], params['style'])}")
     lines.append(t('summary_footer', lang))
     return "\n".join(lines)
 
 
 def generate_lesson_id():
-    timestamp = datetime.utcnow().isoformat()
-    random_part = hashlib.md5(timestamp.encode()).hexdigest()[:8]
-    return f"les_{random_part}"
+    return f"les_{secrets.token_hex(4)}"
 
 
 def create_lesson_record(params, content, teacher_name=None, public=True):
@@ -1032,56 +1341,159 @@ def create_lesson_record(params, content, teacher_name=None, public=True):
 # GITHUB OPERATIONS
 # ============================================================================
 
+# One pooled HTTP/2 connection to the GitHub API, reused by every storage call
+github_client = httpx.AsyncClient(
+    base_url="https://api.github.com",
+    headers={"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github.v3+json"},
+    http2=True,
+    timeout=30.0,
+    # httpx drops idle connections after 5s by default; shares arrive minutes apart, so keep
+    # the connection warm longer and skip a TLS handshake on most writes
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=8, keepalive_expiry=60.0),
+)
+
+# Parsed lessons files keyed by API path, revalidated with If-None-Match so an unchanged
+# file costs a 304 (which GitHub doesn't count against the rate limit) and no decode.
+# After our own PUT the entry holds what we wrote and the sha GitHub returned, with no
+# etag: the next write starts from it without a GET, and a 409 means someone else wrote.
+_github_file_cache = {}
+
+
+async def get_github_json(path):
+    """Return (data, sha) for a JSON lessons file, or an empty list and no sha if it's missing"""
+    cached = _github_file_cache.get(path)
+    if cached and cached[0] is None:
+        _, data, sha = cached
+        return {**data, "lessons": list(data.get("lessons", []))}, sha
+    
+    response = await github_client.get(path, headers={"If-None-Match": cached[0]} if cached else None)
+    logger.info(f"GitHub GET {path}: {response.status_code}")
+    
+    if response.status_code == 304:
+        _, data, sha = cached
+    elif response.status_code == 200:
+        file_data = response.json()
+        data = orjson.loads(base64.b64decode(file_data['content']))
+        sha = file_data['sha']
+        if response.headers.get('etag'):
+            _github_file_cache[path] = (response.headers['etag'], data, sha)
+    else:
+        return {"lessons": []}, None
+    
+    # Callers rebuild the lessons list, so hand out a fresh one
+    return {**data, "lessons": list(data.get("lessons", []))}, sha
+
+
+# A 409 means another writer moved the file since we read it; each retry re-reads it, and
+# a short jittered pause keeps two racing writers from colliding again in lockstep
+GITHUB_PUT_ATTEMPTS = 5
+
+
+async def update_github_json(path, update, message):
+    """Apply `update` to a JSON lessons file in place and PUT it back; returns the response.
+    If the sha turns out stale (409), re-read the file and retry, up to GITHUB_PUT_ATTEMPTS."""
+    for attempt in range(GITHUB_PUT_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(random.uniform(0.1, 0.5) * attempt)
+        existing, sha = await get_github_json(path)
+        update(existing)
+        
+        body = {
+            "message": message,
+            "content": base64.b64encode(orjson.dumps(existing, option=orjson.OPT_INDENT_2)).decode('ascii'),
+        }
+        if sha:
+            body["sha"] = sha
+        
+        response = await github_client.put(path, json=body)
+        if response.status_code in (200, 201):
+            _github_file_cache[path] = (None, existing, response.json()['content']['sha'])
+            return response
+        _github_file_cache.pop(path, None)
+        if response.status_code != 409:
+            break
+        logger.warning(f"GitHub PUT {path}: sha conflict, re-reading ({attempt + 1}/{GITHUB_PUT_ATTEMPTS})")
+    return response
+
+
+# Shared lessons are queued and written to the library repo in batches: one GET + PUT
+# per GITHUB_BATCH_SIZE lessons or GITHUB_BATCH_WINDOW seconds, whichever comes first
+GITHUB_BATCH_SIZE = 64
+GITHUB_BATCH_WINDOW = 2.0
+_github_queue = asyncio.Queue()
+_github_flush_task = None
+# The batch write in progress; shutdown waits for it instead of cancelling it mid-PUT
+_github_write = None
+
+
 async def save_lesson_to_github(lesson):
     if not GITHUB_TOKEN or not GITHUB_REPO:
         logger.info("GitHub not configured for lesson storage")
         return False
     
+    _github_queue.put_nowait(lesson)
+    return True
+
+
+async def write_lessons_to_github(lessons):
+    def add_lessons(existing):
+        # Queue order is oldest first; the file keeps newest first
+        existing["lessons"][:0] = reversed(lessons)
+        del existing["lessons"][100:]
+    
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            get_response = await client.get(
-                f"https://api.github.com/repos/{GITHUB_REPO}/contents/{LESSONS_FILE}",
-                headers={"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github.v3+json"}
-            )
-            
-            if get_response.status_code == 200:
-                file_data = get_response.json()
-                existing = json.loads(base64.b64decode(file_data['content']).decode('utf-8'))
-                sha = file_data['sha']
-            else:
-                existing = {"lessons": []}
-                sha = None
-            
-            existing["lessons"].insert(0, lesson)
-            existing["lessons"] = existing["lessons"][:100]
-            
-            new_content = base64.b64encode(json.dumps(existing, indent=2).encode('utf-8')).decode('utf-8')
-            
-            body = {
-                "message": f"Add lesson: {lesson['topic']}",
-                "content": new_content,
-            }
-            if sha:
-                body["sha"] = sha
-            
-            put_response = await client.put(
-                f"https://api.github.com/repos/{GITHUB_REPO}/contents/{LESSONS_FILE}",
-                headers={"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github.v3+json"},
-                json=body
-            )
-            
-            if put_response.status_code in [200, 201]:
-                logger.info(f"Saved to GitHub: {lesson['topic']}")
-                return True
-            else:
-                logger.error(f"GitHub save failed: {put_response.text[:200]}")
-                return False
+        put_response = await update_github_json(
+            f"/repos/{GITHUB_REPO}/contents/{LESSONS_FILE}",
+            add_lessons,
+            f"Add lesson: {lessons[0]['topic']}" if len(lessons) == 1 else f"Add {len(lessons)} lessons",
+        )
+        
+        if put_response.status_code in [200, 201]:
+            logger.info(f"Saved {len(lessons)} lesson(s) to GitHub")
+            return True
+        else:
+            logger.error(f"GitHub save failed: {put_response.text[:200]}")
+            return False
     
-    except Exception as e:
-        logger.error(f"GitHub error: {e}")
+    except Exception:
+        logger.exception("GitHub error")
         return False
 
 
+async def github_flush_loop():
+    global _github_write
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _github_queue.get()]
+        deadline = loop.time() + GITHUB_BATCH_WINDOW
+        try:
+            while len(batch) < GITHUB_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_github_queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Shutting down mid-window: hand the batch back for flush_github_queue
+            for lesson in batch:
+                _github_queue.put_nowait(lesson)
+            raise
+        _github_write = asyncio.ensure_future(write_lessons_to_github(batch))
+        await asyncio.shield(_github_write)
+
+
+async def flush_github_queue():
+    if _github_write and not _github_write.done():
+        await _github_write
+    batch = []
+    while not _github_queue.empty():
+        batch.append(_github_queue.get_nowait())
+    if batch:
+        await write_lessons_to_github(batch)
+
+
 async def push_lesson_to_website(lesson):
     if not GITHUB_TOKEN or not GITHUB_WEBSITE_REPO:
         logger.info("Website repo not configured")
@@ -1099,57 +1511,142 @@ async def push_lesson_to_website(lesson):
             "created": lesson["created"],
         }
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            get_url = f"https://api.github.com/repos/{GITHUB_WEBSITE_REPO}/contents/lessons.json"
-            get_response = await client.get(
-                get_url,
-                headers={"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github.v3+json"}
-            )
-            
-            logger.info(f"GET status: {get_response.status_code}")
-            
-            if get_response.status_code == 200:
-                file_data = get_response.json()
-                existing = json.loads(base64.b64decode(file_data['content']).decode('utf-8'))
-                sha = file_data['sha']
-            else:
-                existing = {"lessons": []}
-                sha = None
-            
+        def add_lesson(existing):
             existing["lessons"].insert(0, carousel_lesson)
-            existing["lessons"] = existing["lessons"][:20]
-            
-            new_content = base64.b64encode(json.dumps(existing, indent=2).encode('utf-8')).decode('utf-8')
-            
-            body = {
-                "message": f"Add lesson: {carousel_lesson['topic']}",
-                "content": new_content,
-            }
-            if sha:
-                body["sha"] = sha
-            
-            put_url = f"https://api.github.com/repos/{GITHUB_WEBSITE_REPO}/contents/lessons.json"
-            put_response = await client.put(
-                put_url,
-                headers={"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github.v3+json"},
-                json=body
-            )
-            
-            logger.info(f"PUT status: {put_response.status_code}")
-            
-            if put_response.status_code in [200, 201]:
-                logger.info(f"✅ Pushed to website: {carousel_lesson['topic']}")
-                return True
-            else:
-                logger.error(f"PUT failed: {put_response.text[:300]}")
-                return False
+            del existing["lessons"][20:]
+        
+        put_response = await update_github_json(
+            f"/repos/{GITHUB_WEBSITE_REPO}/contents/lessons.json",
+            add_lesson,
+            f"Add lesson: {carousel_lesson['topic']}",
+        )
+        
+        logger.info(f"PUT status: {put_response.status_code}")
+        
+        if put_response.status_code in [200, 201]:
+            logger.info(f"✅ Pushed to website: {carousel_lesson['topic']}")
+            return True
+        else:
+            logger.error(f"PUT failed: {put_response.text[:300]}")
+            return False
     
-    except Exception as e:
-        logger.error(f"Website push error: {e}")
-        logger.error(traceback.format_exc())
+    except Exception:
+        logger.exception("Website push error")
         return False
 
 
+# ============================================================================
+# KEYBOARDS
+# ============================================================================
+# Static menus are built once per language at import; handlers just pick one
+
+def _per_lang(build):
+    return {lang: InlineKeyboardMarkup(build(lang)) for lang in TRANSLATIONS}
+
+def _country_rows(lang):
+    countries = get_countries(lang)
+    rows = [[InlineKeyboardButton(t('country_global', lang), callback_data="country_Global")]]
+    for i in range(0, len(countries), 2):
+        rows.append([InlineKeyboardButton(f"{flag} {name}", callback_data=f"country_{name}") for flag, name in countries[i:i + 2]])
+    return rows
+
+LANGUAGE_PROMPT = "🌐 <b>Choose your language / Elige tu idioma:</b>"
+LANGUAGE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🇬🇧 English", callback_data="lang_en")],
+    [InlineKeyboardButton("🇪🇸 Español", callback_data="lang_es")],
+])
+
+MAIN_MENU_MARKUP = _per_lang(lambda lang: [
+    [InlineKeyboardButton(t('quick_lesson', lang), callback_data="action_quick")],
+    [InlineKeyboardButton(t('custom_lesson', lang), callback_data="action_new")],
+    [InlineKeyboardButton(t('help_tips', lang), callback_data="action_help")],
+    [InlineKeyboardButton(t('change_language', lang), callback_data="action_language")],
+])
+
+QUICK_SUBJECT_MARKUP = _per_lang(lambda lang: [
+    [InlineKeyboardButton(t('subj_mathematics', lang), callback_data="quick_Mathematics")],
+    [InlineKeyboardButton(t('subj_science', lang), callback_data="quick_Science")],
+    [InlineKeyboardButton(t('subj_reading', lang), callback_data="quick_Reading")],
+    [InlineKeyboardButton(t('subj_language', lang), callback_data="quick_Language")],
+    [InlineKeyboardButton(t('subj_social', lang), callback_data="quick_Social Studies")],
+    [InlineKeyboardButton(t('subj_art', lang), callback_data="quick_Art")],
+])
+
+SUBJECT_MARKUP = _per_lang(lambda lang: [
+    [InlineKeyboardButton(t('subj_mathematics', lang), callback_data="subject_Mathematics")],
+    [InlineKeyboardButton(t('subj_science', lang), callback_data="subject_Science")],
+    [InlineKeyboardButton(t('subj_reading', lang), callback_data="subject_Reading")],
+    [InlineKeyboardButton(t('subj_language', lang), callback_data="subject_Language")],
+    [InlineKeyboardButton(t('subj_social', lang), callback_data="subject_Social Studies")],
+    [InlineKeyboardButton(t('subj_art', lang), callback_data="subject_Art")],
+    [InlineKeyboardButton(t('subj_other', lang), callback_data="subject_other")],
+])
+
+BACK_MARKUP = _per_lang(lambda lang: [[InlineKeyboardButton(t('back', lang), callback_data="action_menu")]])
+
+# Topic suggestions are a fresh random sample per click, so prebuild every topic's row
+# and let cb_subject sample rows instead of building buttons
+TOPIC_ROWS = {
+    lang: {
+        subject: [[InlineKeyboardButton(topic, callback_data=f"topic_{topic}")] for topic in topics]
+        for subject, topics in get_topics_by_subject(lang).items()
+    }
+    for lang in TRANSLATIONS
+}
+TOPIC_CUSTOM_ROW = {lang: [InlineKeyboardButton(t('topic_custom', lang), callback_data="topic_custom")] for lang in TRANSLATIONS}
+# Typed subjects have no suggestion pool, so only the custom-topic button is offered
+TOPIC_CUSTOM_MARKUP = _per_lang(lambda lang: [TOPIC_CUSTOM_ROW[lang]])
+
+AGES_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("5-7", callback_data="ages_5-7"),
+     InlineKeyboardButton("7-9", callback_data="ages_7-9"),
+     InlineKeyboardButton("9-11", callback_data="ages_9-11")],
+    [InlineKeyboardButton("11-13", callback_data="ages_11-13"),
+     InlineKeyboardButton("13-15", callback_data="ages_13-15"),
+     InlineKeyboardButton("15+", callback_data="ages_15-18")],
+])
+
+DURATION_MARKUP = _per_lang(lambda lang: [
+    [InlineKeyboardButton(f"15 {t('min', lang)}", callback_data="dur_15"),
+     InlineKeyboardButton(f"30 {t('min', lang)}", callback_data="dur_30")],
+    [InlineKeyboardButton(f"45 {t('min', lang)}", callback_data="dur_45"),
+     InlineKeyboardButton(f"60 {t('min', lang)}", callback_data="dur_60")],
+])
+
+COUNTRY_MARKUP = _per_lang(_country_rows)
+
+MATERIALS_MARKUP = _per_lang(lambda lang: [
+    [InlineKeyboardButton(t('mat_none', lang), callback_data="mat_none")],
+    [InlineKeyboardButton(t('mat_basic', lang), callback_data="mat_basic")],
+    [InlineKeyboardButton(t('mat_standard', lang), callback_data="mat_standard")],
+])
+
+STYLE_MARKUP = _per_lang(lambda lang: [
+    [InlineKeyboardButton(t('style_interactive', lang), callback_data="style_interactive")],
+    [InlineKeyboardButton(t('style_structured', lang), callback_data="style_structured")],
+    [InlineKeyboardButton(t('style_storytelling', lang), callback_data="style_storytelling")],
+    [InlineKeyboardButton(t('style_mixed', lang), callback_data="style_mixed")],
+])
+
+FORMAT_MARKUP = _per_lang(lambda lang: [
+    [InlineKeyboardButton(t('fmt_chat', lang), callback_data="format_chat")],
+    [InlineKeyboardButton(t('fmt_pdf', lang), callback_data="format_pdf"),
+     InlineKeyboardButton(t('fmt_html', lang), callback_data="format_html")],
+    [InlineKeyboardButton(t('fmt_chatpdf', lang), callback_data="format_chatpdf"),
+     InlineKeyboardButton(t('fmt_chathtml', lang), callback_data="format_chathtml")],
+])
+
+SHARE_MARKUP = _per_lang(lambda lang: [
+    [InlineKeyboardButton(t('share_yes', lang), callback_data="share_yes"),
+     InlineKeyboardButton(t('share_no', lang), callback_data="share_no")],
+])
+
+NEXT_STEP_MARKUP = _per_lang(lambda lang: [
+    [InlineKeyboardButton(t('new_lesson', lang), callback_data="action_new")],
+    [InlineKeyboardButton(t('menu', lang), callback_data="action_menu")],
+])
+
+
 # ============================================================================
 # TELEGRAM HANDLERS
 # ============================================================================
@@ -1162,32 +1659,21 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"START from user {user_id}")
     
     # If no language set, ask for language first
-    if session.get('lang') is None:
-        session['state'] = 'awaiting_language'
-        keyboard = [
-            [InlineKeyboardButton("🇬🇧 English", callback_data="lang_en")],
-            [InlineKeyboardButton("🇪🇸 Español", callback_data="lang_es")],
-        ]
+    if session.lang is None:
+        session.state = State.AWAITING_LANGUAGE
         await update.message.reply_text(
-            "🌐 *Choose your language / Elige tu idioma:*",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
+            LANGUAGE_PROMPT,
+            reply_markup=LANGUAGE_MARKUP,
+            parse_mode=ParseMode.HTML
         )
         return
     
     # Language already set, show main menu
     lang = get_lang(user_id)
-    keyboard = [
-        [InlineKeyboardButton(t('quick_lesson', lang), callback_data="action_quick")],
-        [InlineKeyboardButton(t('custom_lesson', lang), callback_data="action_new")],
-        [InlineKeyboardButton(t('help_tips', lang), callback_data="action_help")],
-        [InlineKeyboardButton(t('change_language', lang), callback_data="action_language")],
-    ]
-    
     await update.message.reply_text(
         t('welcome', lang),
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode='Markdown'
+        reply_markup=MAIN_MENU_MARKUP[lang],
+        parse_mode=ParseMode.HTML
     )
 
 
@@ -1195,44 +1681,40 @@ async def language_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Change language anytime with /language"""
     user_id = update.effective_user.id
     session = get_session(user_id)
-    session['state'] = 'awaiting_language'
+    session.state = State.AWAITING_LANGUAGE
     
-    keyboard = [
-        [InlineKeyboardButton("🇬🇧 English", callback_data="lang_en")],
-        [InlineKeyboardButton("🇪🇸 Español", callback_data="lang_es")],
-    ]
     await update.message.reply_text(
-        "🌐 *Choose your language / Elige tu idioma:*",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode='Markdown'
+        LANGUAGE_PROMPT,
+        reply_markup=LANGUAGE_MARKUP,
+        parse_mode=ParseMode.HTML
     )
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     lang = get_lang(user_id)
-    await update.message.reply_text(t('help_command', lang), parse_mode='Markdown')
+    await update.message.reply_text(t('help_command', lang), parse_mode=ParseMode.HTML)
 
 
 async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     lang = get_lang(user_id)
-    await update.message.reply_text(t('about', lang), parse_mode='Markdown')
+    await update.message.reply_text(t('about', lang), parse_mode=ParseMode.HTML)
 
 
 async def subjects_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     lang = get_lang(user_id)
-    await update.message.reply_text(t('subjects_list', lang), parse_mode='Markdown')
+    await update.message.reply_text(t('subjects_list', lang), parse_mode=ParseMode.HTML)
 
 
 async def feedback_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     session = get_session(user_id)
     lang = get_lang(user_id)
-    session['state'] = 'awaiting_feedback'
+    session.state = State.AWAITING_FEEDBACK
     
-    await update.message.reply_text(t('feedback_prompt', lang), parse_mode='Markdown')
+    await update.message.reply_text(t('feedback_prompt', lang), parse_mode=ParseMode.HTML)
 
 
 async def lesson_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1240,22 +1722,12 @@ async def lesson_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reset_session(user_id)
     session = get_session(user_id)
     lang = get_lang(user_id)
-    session['state'] = 'awaiting_subject'
-    
-    keyboard = [
-        [InlineKeyboardButton(t('subj_mathematics', lang), callback_data="subject_Mathematics")],
-        [InlineKeyboardButton(t('subj_science', lang), callback_data="subject_Science")],
-        [InlineKeyboardButton(t('subj_reading', lang), callback_data="subject_Reading")],
-        [InlineKeyboardButton(t('subj_language', lang), callback_data="subject_Language")],
-        [InlineKeyboardButton(t('subj_social', lang), callback_data="subject_Social Studies")],
-        [InlineKeyboardButton(t('subj_art', lang), callback_data="subject_Art")],
-        [InlineKeyboardButton(t('subj_other', lang), callback_data="subject_other")],
-    ]
+    session.state = State.AWAITING_SUBJECT
     
     await update.message.reply_text(
         t('subject_prompt', lang),
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode='Markdown'
+        reply_markup=SUBJECT_MARKUP[lang],
+        parse_mode=ParseMode.HTML
     )
 
 
@@ -1263,515 +1735,499 @@ async def lesson_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # CALLBACK HANDLER
 # ============================================================================
 
-async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
-    data = query.data
-    user_id = update.effective_user.id
+# LANGUAGE SELECTION
+async def cb_language_selected(query, context, session, lang, payload):
+    selected_lang = payload
+    if selected_lang not in TRANSLATIONS:
+        selected_lang = "en"
+    session.lang = selected_lang
+    session.state = State.IDLE
+    lang = selected_lang
+    
+    await query.edit_message_text(
+        f"{t('lang_changed', lang)}\n\n{t('welcome_back', lang)}",
+        reply_markup=MAIN_MENU_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+
+
+# ACTION: Change language
+async def cb_change_language(query, context, session, lang, payload):
+    session.state = State.AWAITING_LANGUAGE
+    await query.edit_message_text(
+        LANGUAGE_PROMPT,
+        reply_markup=LANGUAGE_MARKUP,
+        parse_mode=ParseMode.HTML
+    )
+
+
+# ACTION: Quick Lesson
+async def cb_quick_menu(query, context, session, lang, payload):
+    logger.info(f">>> action_quick")
+    await query.edit_message_text(
+        t('quick_title', lang),
+        reply_markup=QUICK_SUBJECT_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+
+
+# ACTION: Help
+async def cb_help(query, context, session, lang, payload):
+    logger.info(f">>> action_help")
+    await query.edit_message_text(
+        t('help_text', lang),
+        reply_markup=BACK_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+
+
+# ACTION: Menu
+async def cb_menu(query, context, session, lang, payload):
+    user_id = query.from_user.id
+    logger.info(f">>> action_menu")
+    reset_session(user_id)
+    await query.edit_message_text(
+        t('welcome_back', lang),
+        reply_markup=MAIN_MENU_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+
+
+# ACTION: New custom lesson
+async def cb_new_lesson(query, context, session, lang, payload):
+    user_id = query.from_user.id
+    logger.info(f">>> action_new")
+    reset_session(user_id)
     session = get_session(user_id)
-    lang = get_lang(user_id)
-    
-    logger.info(f"=== CALLBACK: '{data}' from user {user_id} (lang={lang}) ===")
+    session.state = State.AWAITING_SUBJECT
     
-    # LANGUAGE SELECTION
-    if data.startswith("lang_"):
-        selected_lang = data.replace("lang_", "")
-        session['lang'] = selected_lang
-        session['state'] = 'idle'
-        lang = selected_lang
-        
-        keyboard = [
-            [InlineKeyboardButton(t('quick_lesson', lang), callback_data="action_quick")],
-            [InlineKeyboardButton(t('custom_lesson', lang), callback_data="action_new")],
-            [InlineKeyboardButton(t('help_tips', lang), callback_data="action_help")],
-            [InlineKeyboardButton(t('change_language', lang), callback_data="action_language")],
-        ]
-        
-        await query.edit_message_text(
-            f"{t('lang_changed', lang)}\n\n{t('welcome_back', lang)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        return
+    await query.edit_message_text(
+        t('subject_prompt', lang),
+        reply_markup=SUBJECT_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+
+
+# The per-user lock queues a double tap behind the first generation instead of dropping it.
+# The pressed message is edited to "generating" on the first tap, so a second tap on the
+# same message is a duplicate and is ignored.
+def claim_generation(query, session):
+    message_id = query.message.message_id if query.message else None
+    if message_id is not None and session.generated_from == message_id:
+        logger.info(f"Ignoring repeat generate press on message {message_id}")
+        return False
+    session.generated_from = message_id
+    return True
+
+
+# Telegram file_ids of documents already uploaded, keyed on everything they're rendered from.
+# A repeated lesson (a LESSON_CACHE hit) is re-sent by id: no render and no upload.
+DOCUMENT_FILE_IDS = LRUCache(maxsize=1000)
+
+def document_key(ext, lesson_content, params, lang):
+    source = orjson.dumps([ext, lang, params, lesson_content], option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(source).digest()
+
+
+# Shared by quick lessons and the custom flow's format step
+async def deliver_lesson(context, user_id, session, lang, chat, pdf, html, status=None, model=LESSON_MODEL):
+    # The "generating" message shows the lesson as it streams in, then becomes the chat copy
+    # of the lesson itself (or "ready" when chat wasn't asked for) - one edit, no extra message
+    async def preview(text):
+        try:
+            await status.edit_message_text(f"{text[:3900]}\n\n⏳")
+        except TelegramError as e:
+            logger.warning(f"Preview edit failed: {e}")
     
-    # ACTION: Change language
-    if data == "action_language":
-        session['state'] = 'awaiting_language'
-        keyboard = [
-            [InlineKeyboardButton("🇬🇧 English", callback_data="lang_en")],
-            [InlineKeyboardButton("🇪🇸 Español", callback_data="lang_es")],
-        ]
-        await query.edit_message_text(
-            "🌐 *Choose your language / Elige tu idioma:*",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        return
+    async def mark_ready():
+        try:
+            if chat:
+                await status.edit_message_text(lesson_content[:4000])
+            else:
+                await status.edit_message_text(t('lesson_ready', lang), parse_mode=ParseMode.HTML)
+        except TelegramError as e:
+            logger.warning(f"Status edit failed: {e}")
+            if chat:
+                await context.bot.send_message(chat_id=user_id, text=lesson_content[:4000])
     
-    # ACTION: Quick Lesson
-    if data == "action_quick":
-        logger.info(f">>> action_quick")
-        keyboard = [
-            [InlineKeyboardButton(t('subj_mathematics', lang), callback_data="quick_Mathematics")],
-            [InlineKeyboardButton(t('subj_science', lang), callback_data="quick_Science")],
-            [InlineKeyboardButton(t('subj_reading', lang), callback_data="quick_Reading")],
-            [InlineKeyboardButton(t('subj_language', lang), callback_data="quick_Language")],
-            [InlineKeyboardButton(t('subj_social', lang), callback_data="quick_Social Studies")],
-            [InlineKeyboardButton(t('subj_art', lang), callback_data="quick_Art")],
-        ]
-        await query.edit_message_text(
-            t('quick_title', lang),
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
+    lesson_content = await generate_lesson(session.params, lang, preview=preview if status else None, model=model)
+    session.last_lesson = lesson_content
+    filename = generate_lesson_filename(session.params)
+    
+    async def send_file(ext, caption, build):
+        key = document_key(ext, lesson_content, session.params, lang)
+        document = DOCUMENT_FILE_IDS.get(key)
+        if document is None:
+            data = await build()
+            if not data:
+                return
+            document = InputFile(data, filename=f"{filename}.{ext}")
+        message = await context.bot.send_document(chat_id=user_id, document=document, caption=caption)
+        DOCUMENT_FILE_IDS[key] = message.document.file_id
+    
+    # Split once for whichever of the PDF and HTML actually get rendered
+    lines = None
+    def content_lines():
+        nonlocal lines
+        if lines is None:
+            lines = lesson_content.split('\n')
+        return lines
+    
+    async def build_pdf():
+        return await render_pdf(content_lines(), session.params, lang)
+    
+    async def build_html():
+        html_content = await render(create_lesson_html, content_lines(), session.params, lang)
+        return html_content.encode('utf-8')
+    
+    # The formats don't depend on each other, so render and upload them side by side, and
+    # the renders overlap the status edit's round trip; the share prompt waits for all of
+    # them so its buttons arrive last
+    sends = [mark_ready()] if status else []
+    if chat and not status:
+        sends.append(context.bot.send_message(chat_id=user_id, text=lesson_content[:4000]))
+    if pdf:
+        sends.append(send_file('pdf', "📄 PDF", build_pdf))
+    if html:
+        sends.append(send_file('html', "🌐 HTML", build_html))
+    await asyncio.gather(*sends)
+    
+    await context.bot.send_message(
+        chat_id=user_id,
+        text=t('share_prompt', lang),
+        reply_markup=SHARE_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+
+
+# QUICK LESSON - generate immediately
+async def cb_quick_lesson(query, context, session, lang, payload):
+    user_id = query.from_user.id
+    subject = payload
+    logger.info(f">>> quick lesson: {subject}")
+    if not claim_generation(query, session):
         return
     
-    # ACTION: Help
-    if data == "action_help":
-        logger.info(f">>> action_help")
-        keyboard = [[InlineKeyboardButton(t('back', lang), callback_data="action_menu")]]
-        await query.edit_message_text(
-            t('help_text', lang),
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        return
+    topics = get_random_topics(subject, 1, lang)
+    topic = topics[0] if topics else "Introduction"
+    
+    session.params.clear()
+    session.params.update(
+        subject=subject,
+        topic=topic,
+        ages='9-11',
+        duration='30',
+        country='Global',
+        materials='basic',
+        style='mixed'
+    )
     
-    # ACTION: Menu
-    if data == "action_menu":
-        logger.info(f">>> action_menu")
-        reset_session(user_id)
-        keyboard = [
-            [InlineKeyboardButton(t('quick_lesson', lang), callback_data="action_quick")],
-            [InlineKeyboardButton(t('custom_lesson', lang), callback_data="action_new")],
-            [InlineKeyboardButton(t('help_tips', lang), callback_data="action_help")],
-            [InlineKeyboardButton(t('change_language', lang), callback_data="action_language")],
-        ]
-        await query.edit_message_text(
-            t('welcome_back', lang),
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        return
+    await query.edit_message_text(t('generating', lang), parse_mode=ParseMode.HTML)
     
-    # ACTION: New custom lesson
-    if data == "action_new":
-        logger.info(f">>> action_new")
-        reset_session(user_id)
-        session = get_session(user_id)
-        session['state'] = 'awaiting_subject'
-        
-        keyboard = [
-            [InlineKeyboardButton(t('subj_mathematics', lang), callback_data="subject_Mathematics")],
-            [InlineKeyboardButton(t('subj_science', lang), callback_data="subject_Science")],
-            [InlineKeyboardButton(t('subj_reading', lang), callback_data="subject_Reading")],
-            [InlineKeyboardButton(t('subj_language', lang), callback_data="subject_Language")],
-            [InlineKeyboardButton(t('subj_social', lang), callback_data="subject_Social Studies")],
-            [InlineKeyboardButton(t('subj_art', lang), callback_data="subject_Art")],
-            [InlineKeyboardButton(t('subj_other', lang), callback_data="subject_other")],
-        ]
-        await query.edit_message_text(
-            t('subject_prompt', lang),
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        return
+    try:
+        await deliver_lesson(context, user_id, session, lang, chat=True, pdf=True, html=True, status=query, model=QUICK_LESSON_MODEL)
+    except Exception:
+        logger.exception("Quick lesson error")
+        await context.bot.send_message(chat_id=user_id, text=t('generation_error', lang))
+
+
+# SUBJECT SELECTION
+async def cb_subject(query, context, session, lang, payload):
+    subject = payload
     
-    # QUICK LESSON - generate immediately
-    if data.startswith("quick_"):
-        subject = data.replace("quick_", "")
-        logger.info(f">>> quick lesson: {subject}")
-        
-        topics = get_random_topics(subject, 1, lang)
-        topic = topics[0] if topics else "Introduction"
-        
-        session['params'] = {
-            'subject': subject,
-            'topic': topic,
-            'ages': '9-11',
-            'duration': '30',
-            'country': 'Global',
-            'materials': 'basic',
-            'style': 'mixed'
-        }
-        
-        await query.edit_message_text(t('generating', lang), parse_mode='Markdown')
-        
-        try:
-            lesson_content = generate_lesson(session['params'], lang)
-            session['last_lesson'] = lesson_content
-            
-            # Send chat message
-            await context.bot.send_message(chat_id=user_id, text=lesson_content[:4000])
-            
-            # Send PDF
-            pdf_data = create_lesson_pdf(lesson_content, session['params'], lang)
-            if pdf_data:
-                filename = generate_lesson_filename(session['params'])
-                pdf_buffer = BytesIO(pdf_data)
-                pdf_buffer.seek(0)
-                await context.bot.send_document(
-                    chat_id=user_id,
-                    document=InputFile(pdf_buffer, filename=f"{filename}.pdf"),
-                    caption="📄 PDF"
-                )
-            
-            # Send HTML
-            html_content = create_lesson_html(lesson_content, session['params'], lang)
-            html_buffer = BytesIO(html_content.encode('utf-8'))
-            html_buffer.seek(0)
-            filename = generate_lesson_filename(session['params'])
-            await context.bot.send_document(
-                chat_id=user_id,
-                document=InputFile(html_buffer, filename=f"{filename}.html"),
-                caption="🌐 HTML"
-            )
-            
-            # Share prompt
-            keyboard = [
-                [InlineKeyboardButton(t('share_yes', lang), callback_data="share_yes"),
-                 InlineKeyboardButton(t('share_no', lang), callback_data="share_no")],
-            ]
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=t('share_prompt', lang),
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
-        except Exception as e:
-            logger.error(f"Quick lesson error: {e}")
-            logger.error(traceback.format_exc())
-            await context.bot.send_message(chat_id=user_id, text=t('generation_error', lang))
+    if subject == "other":
+        session.state = State.AWAITING_SUBJECT_TEXT
+        await query.edit_message_text(t('subject_other_prompt', lang))
         return
     
-    # SUBJECT SELECTION
-    if data.startswith("subject_"):
-        subject = data.replace("subject_", "")
-        
-        if subject == "other":
-            session['state'] = 'awaiting_subject_text'
-            await query.edit_message_text(t('subject_other_prompt', lang))
-            return
-        
-        session['params']['subject'] = subject
-        session['state'] = 'awaiting_topic'
-        
-        topics = get_random_topics(subject, 6, lang)
-        keyboard = [[InlineKeyboardButton(topic, callback_data=f"topic_{topic}")] for topic in topics]
-        keyboard.append([InlineKeyboardButton(t('topic_custom', lang), callback_data="topic_custom")])
-        
-        summary = build_selection_summary(session['params'], lang)
-        await query.edit_message_text(
-            f"{summary}\n\n{t('topic_prompt', lang)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        return
+    session.params['subject'] = subject
+    session.state = State.AWAITING_TOPIC
     
-    # TOPIC SELECTION
-    if data.startswith("topic_"):
-        topic = data.replace("topic_", "")
-        
-        if topic == "custom":
-            session['state'] = 'awaiting_topic_text'
-            await query.edit_message_text(t('topic_type_prompt', lang))
-            return
-        
-        session['params']['topic'] = topic
-        session['state'] = 'awaiting_ages'
-        
-        keyboard = [
-            [InlineKeyboardButton("5-7", callback_data="ages_5-7"),
-             InlineKeyboardButton("7-9", callback_data="ages_7-9"),
-             InlineKeyboardButton("9-11", callback_data="ages_9-11")],
-            [InlineKeyboardButton("11-13", callback_data="ages_11-13"),
-             InlineKeyboardButton("13-15", callback_data="ages_13-15"),
-             InlineKeyboardButton("15+", callback_data="ages_15-18")],
-        ]
-        summary = build_selection_summary(session['params'], lang)
-        await query.edit_message_text(
-            f"{summary}\n\n{t('ages_prompt', lang)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        return
+    rows = TOPIC_ROWS[lang].get(subject, [])
+    keyboard = random.sample(rows, 6) if len(rows) > 6 else list(rows)
+    keyboard.append(TOPIC_CUSTOM_ROW[lang])
     
-    # AGES → DURATION
-    if data.startswith("ages_"):
-        session['params']['ages'] = data.replace("ages_", "")
-        session['state'] = 'awaiting_duration'
-        keyboard = [
-            [InlineKeyboardButton(f"15 {t('min', lang)}", callback_data="dur_15"),
-             InlineKeyboardButton(f"30 {t('min', lang)}", callback_data="dur_30")],
-            [InlineKeyboardButton(f"45 {t('min', lang)}", callback_data="dur_45"),
-             InlineKeyboardButton(f"60 {t('min', lang)}", callback_data="dur_60")],
-        ]
-        summary = build_selection_summary(session['params'], lang)
-        await query.edit_message_text(
-            f"{summary}\n\n{t('duration_prompt', lang)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        return
+    summary = build_selection_summary(session.params, lang)
+    await query.edit_message_text(
+        f"{summary}\n\n{t('topic_prompt', lang)}",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode=ParseMode.HTML
+    )
+
+
+# TOPIC SELECTION
+async def cb_topic(query, context, session, lang, payload):
+    topic = payload
     
-    # DURATION → COUNTRY
-    if data.startswith("dur_"):
-        session['params']['duration'] = data.replace("dur_", "")
-        session['state'] = 'awaiting_country'
-        
-        countries = get_countries(lang)
-        keyboard = [[InlineKeyboardButton(t('country_global', lang), callback_data="country_Global")]]
-        for i in range(0, len(countries), 2):
-            row = []
-            for j in range(2):
-                if i + j < len(countries):
-                    flag, name = countries[i + j]
-                    row.append(InlineKeyboardButton(f"{flag} {name}", callback_data=f"country_{name}"))
-            keyboard.append(row)
-        
-        summary = build_selection_summary(session['params'], lang)
-        await query.edit_message_text(
-            f"{summary}\n\n{t('country_prompt', lang)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
+    if topic == "custom":
+        session.state = State.AWAITING_TOPIC_TEXT
+        await query.edit_message_text(t('topic_type_prompt', lang))
         return
     
-    # COUNTRY → MATERIALS
-    if data.startswith("country_"):
-        session['params']['country'] = data.replace("country_", "")
-        session['state'] = 'awaiting_materials'
-        keyboard = [
-            [InlineKeyboardButton(t('mat_none', lang), callback_data="mat_none")],
-            [InlineKeyboardButton(t('mat_basic', lang), callback_data="mat_basic")],
-            [InlineKeyboardButton(t('mat_standard', lang), callback_data="mat_standard")],
-        ]
-        summary = build_selection_summary(session['params'], lang)
-        await query.edit_message_text(
-            f"{summary}\n\n{t('materials_prompt', lang)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        return
+    session.params['topic'] = topic
+    session.state = State.AWAITING_AGES
     
-    # MATERIALS → STYLE
-    if data.startswith("mat_"):
-        session['params']['materials'] = data.replace("mat_", "")
-        session['state'] = 'awaiting_style'
-        keyboard = [
-            [InlineKeyboardButton(t('style_interactive', lang), callback_data="style_interactive")],
-            [InlineKeyboardButton(t('style_structured', lang), callback_data="style_structured")],
-            [InlineKeyboardButton(t('style_storytelling', lang), callback_data="style_storytelling")],
-            [InlineKeyboardButton(t('style_mixed', lang), callback_data="style_mixed")],
-        ]
-        summary = build_selection_summary(session['params'], lang)
-        await query.edit_message_text(
-            f"{summary}\n\n{t('style_prompt', lang)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        return
+    summary = build_selection_summary(session.params, lang)
+    await query.edit_message_text(
+        f"{summary}\n\n{t('ages_prompt', lang)}",
+        reply_markup=AGES_MARKUP,
+        parse_mode=ParseMode.HTML
+    )
+
+
+# AGES → DURATION
+async def cb_ages(query, context, session, lang, payload):
+    session.params['ages'] = payload
+    session.state = State.AWAITING_DURATION
+    summary = build_selection_summary(session.params, lang)
+    await query.edit_message_text(
+        f"{summary}\n\n{t('duration_prompt', lang)}",
+        reply_markup=DURATION_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+
+
+# DURATION → COUNTRY
+async def cb_duration(query, context, session, lang, payload):
+    session.params['duration'] = payload
+    session.state = State.AWAITING_COUNTRY
     
-    # STYLE → FORMAT
-    if data.startswith("style_"):
-        session['params']['style'] = data.replace("style_", "")
-        session['state'] = 'awaiting_format'
-        
-        keyboard = [
-            [InlineKeyboardButton(t('fmt_chat', lang), callback_data="format_chat")],
-            [InlineKeyboardButton(t('fmt_pdf', lang), callback_data="format_pdf"),
-             InlineKeyboardButton(t('fmt_html', lang), callback_data="format_html")],
-            [InlineKeyboardButton(t('fmt_chatpdf', lang), callback_data="format_chatpdf"),
-             InlineKeyboardButton(t('fmt_chathtml', lang), callback_data="format_chathtml")],
-        ]
-        summary = build_selection_summary(session['params'], lang)
-        await query.edit_message_text(
-            f"{summary}\n\n{t('format_prompt', lang)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        return
+    summary = build_selection_summary(session.params, lang)
+    await query.edit_message_text(
+        f"{summary}\n\n{t('country_prompt', lang)}",
+        reply_markup=COUNTRY_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+
+
+# COUNTRY → MATERIALS
+async def cb_country(query, context, session, lang, payload):
+    session.params['country'] = payload
+    session.state = State.AWAITING_MATERIALS
+    summary = build_selection_summary(session.params, lang)
+    await query.edit_message_text(
+        f"{summary}\n\n{t('materials_prompt', lang)}",
+        reply_markup=MATERIALS_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+
+
+# MATERIALS → STYLE
+async def cb_materials(query, context, session, lang, payload):
+    session.params['materials'] = payload
+    session.state = State.AWAITING_STYLE
+    summary = build_selection_summary(session.params, lang)
+    await query.edit_message_text(
+        f"{summary}\n\n{t('style_prompt', lang)}",
+        reply_markup=STYLE_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+
+
+# STYLE → FORMAT
+async def cb_style(query, context, session, lang, payload):
+    session.params['style'] = payload
+    session.state = State.AWAITING_FORMAT
+    prefetch_lesson(session.params, lang)
     
-    # FORMAT SELECTION → GENERATE
-    if data.startswith("format_"):
-        format_choice = data.replace("format_", "")
-        logger.info(f">>> format: {format_choice}")
-        
-        await query.edit_message_text(t('generating', lang), parse_mode='Markdown')
-        
-        try:
-            lesson_content = generate_lesson(session['params'], lang)
-            session['last_lesson'] = lesson_content
-            
-            # Send based on format
-            if format_choice in ['chat', 'chatpdf', 'chathtml']:
-                await context.bot.send_message(chat_id=user_id, text=lesson_content[:4000])
-            
-            if format_choice in ['pdf', 'chatpdf']:
-                pdf_data = create_lesson_pdf(lesson_content, session['params'], lang)
-                if pdf_data:
-                    filename = generate_lesson_filename(session['params'])
-                    pdf_buffer = BytesIO(pdf_data)
-                    pdf_buffer.seek(0)
-                    await context.bot.send_document(
-                        chat_id=user_id,
-                        document=InputFile(pdf_buffer, filename=f"{filename}.pdf"),
-                        caption="📄 PDF"
-                    )
-            
-            if format_choice in ['html', 'chathtml']:
-                html_content = create_lesson_html(lesson_content, session['params'], lang)
-                html_buffer = BytesIO(html_content.encode('utf-8'))
-                html_buffer.seek(0)
-                filename = generate_lesson_filename(session['params'])
-                await context.bot.send_document(
-                    chat_id=user_id,
-                    document=InputFile(html_buffer, filename=f"{filename}.html"),
-                    caption="🌐 HTML"
-                )
-            
-            # Share prompt
-            keyboard = [
-                [InlineKeyboardButton(t('share_yes', lang), callback_data="share_yes"),
-                 InlineKeyboardButton(t('share_no', lang), callback_data="share_no")],
-            ]
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=t('share_prompt', lang),
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
-        except Exception as e:
-            logger.error(f"Generation error: {e}")
-            logger.error(traceback.format_exc())
-            await context.bot.send_message(chat_id=user_id, text=t('generation_error', lang))
+    summary = build_selection_summary(session.params, lang)
+    await query.edit_message_text(
+        f"{summary}\n\n{t('format_prompt', lang)}",
+        reply_markup=FORMAT_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+
+
+# FORMAT SELECTION → GENERATE
+async def cb_format(query, context, session, lang, payload):
+    user_id = query.from_user.id
+    format_choice = payload
+    logger.info(f">>> format: {format_choice}")
+    if not claim_generation(query, session):
         return
     
-    # SHARING
-    if data == "share_yes":
-        logger.info(f">>> share_yes")
-        session['pending_share'] = True
-        session['state'] = 'awaiting_teacher_name'
-        await query.edit_message_text(t('share_name_prompt', lang), parse_mode='Markdown')
-        return
+    await query.edit_message_text(t('generating', lang), parse_mode=ParseMode.HTML)
     
-    if data == "share_no":
-        logger.info(f">>> share_no")
-        if session.get('last_lesson'):
-            lesson_record = create_lesson_record(session['params'], session['last_lesson'], public=False)
-            await save_lesson_to_github(lesson_record)
-        
-        keyboard = [
-            [InlineKeyboardButton(t('new_lesson', lang), callback_data="action_new")],
-            [InlineKeyboardButton(t('menu', lang), callback_data="action_menu")],
-        ]
-        await query.edit_message_text(
-            t('saved_private', lang),
-            reply_markup=InlineKeyboardMarkup(keyboard)
+    try:
+        await deliver_lesson(
+            context, user_id, session, lang,
+            chat=format_choice in ('chat', 'chatpdf', 'chathtml'),
+            pdf=format_choice in ('pdf', 'chatpdf'),
+            html=format_choice in ('html', 'chathtml'),
+            status=query,
         )
-        return
+    except Exception:
+        logger.exception("Generation error")
+        await context.bot.send_message(chat_id=user_id, text=t('generation_error', lang))
+
+
+# SHARING
+async def cb_share_yes(query, context, session, lang, payload):
+    logger.info(f">>> share_yes")
+    session.pending_share = True
+    session.state = State.AWAITING_TEACHER_NAME
+    await query.edit_message_text(t('share_name_prompt', lang), parse_mode=ParseMode.HTML)
+
+
+async def cb_share_no(query, context, session, lang, payload):
+    logger.info(f">>> share_no")
+    if session.last_lesson:
+        lesson_record = create_lesson_record(session.params, session.last_lesson, public=False)
+        await save_lesson_to_github(lesson_record)
+        session.last_lesson = None
     
-    logger.warning(f"Unknown callback: {data}")
+    await query.edit_message_text(
+        t('saved_private', lang),
+        reply_markup=NEXT_STEP_MARKUP[lang]
+    )
 
 
-# ============================================================================
-# TEXT HANDLER
-# ============================================================================
+# Exact callback_data matches first, then the part before the first '_'
+CALLBACK_HANDLERS = {
+    "lang": cb_language_selected,
+    "action_language": cb_change_language,
+    "action_quick": cb_quick_menu,
+    "action_help": cb_help,
+    "action_menu": cb_menu,
+    "action_new": cb_new_lesson,
+    "quick": cb_quick_lesson,
+    "subject": cb_subject,
+    "topic": cb_topic,
+    "ages": cb_ages,
+    "dur": cb_duration,
+    "country": cb_country,
+    "mat": cb_materials,
+    "style": cb_style,
+    "format": cb_format,
+    "share_yes": cb_share_yes,
+    "share_no": cb_share_no,
+}
 
-async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+
+# Clients may cache the ack for cache_time seconds, so a mashed button doesn't come back as
+# more updates; buttons that start generation get a window long enough to cover it
+CALLBACK_CACHE_TIME = 2
+GENERATE_CACHE_TIME = 30
+GENERATE_CALLBACKS = frozenset({"quick", "format"})
+
+
+async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    prefix, _, payload = data.partition("_")
+    await query.answer(cache_time=GENERATE_CACHE_TIME if prefix in GENERATE_CALLBACKS else CALLBACK_CACHE_TIME)
+    
     user_id = update.effective_user.id
     session = get_session(user_id)
     lang = get_lang(user_id)
-    text = update.message.text.strip()
-    state = session.get('state', 'idle')
     
-    logger.info(f"Text from {user_id}: '{text[:30]}...' state={state}")
+    logger.info(f"=== CALLBACK: '{data}' from user {user_id} (lang={lang}) ===")
     
-    # Handle feedback
-    if state == 'awaiting_feedback':
-        user = update.effective_user
-        username = user.username or "no_username"
-        name = user.full_name or "Anonymous"
-        
-        logger.info(f"FEEDBACK from {name} (@{username}): {text}")
-        
-        keyboard = [
-            [InlineKeyboardButton(t('new_lesson', lang), callback_data="action_new")],
-            [InlineKeyboardButton(t('menu', lang), callback_data="action_menu")],
-        ]
-        
-        await update.message.reply_text(
-            t('feedback_thanks', lang),
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
-        
-        session['state'] = 'idle'
+    handler = CALLBACK_HANDLERS.get(data) or CALLBACK_HANDLERS.get(prefix)
+    if handler is None:
+        logger.warning(f"Unknown callback: {data}")
         return
+    await handler(query, context, session, lang, payload)
+
+
+# ============================================================================
+# TEXT HANDLER
+# ============================================================================
+
+# FEEDBACK
+async def text_feedback(update, context, session, lang, text):
+    user = update.effective_user
+    username = user.username or "no_username"
+    name = user.full_name or "Anonymous"
     
-    if state == 'awaiting_teacher_name':
-        teacher_name = "Anonymous" if text.lower() == 'skip' else text
-        
-        lesson_record = create_lesson_record(session['params'], session['last_lesson'], teacher_name=teacher_name, public=True)
-        await save_lesson_to_github(lesson_record)
-        website_pushed = await push_lesson_to_website(lesson_record)
-        
-        keyboard = [
-            [InlineKeyboardButton(t('new_lesson', lang), callback_data="action_new")],
-            [InlineKeyboardButton(t('menu', lang), callback_data="action_menu")],
-        ]
-        
-        if website_pushed:
-            await update.message.reply_text(
-                t('share_success', lang),
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
-        else:
-            await update.message.reply_text(
-                t('share_success_basic', lang),
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
-        
-        session['state'] = 'idle'
-        return
+    logger.info(f"FEEDBACK from {name} (@{username}): {text}")
+    
+    await update.message.reply_text(
+        t('feedback_thanks', lang),
+        reply_markup=NEXT_STEP_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+    
+    session.state = State.IDLE
+
+
+# TEACHER NAME → SHARE
+async def text_teacher_name(update, context, session, lang, text):
+    teacher_name = "Anonymous" if text.lower() == 'skip' else text
+    
+    lesson_record = create_lesson_record(session.params, session.last_lesson, teacher_name=teacher_name, public=True)
+    _, website_pushed = await asyncio.gather(
+        save_lesson_to_github(lesson_record),
+        push_lesson_to_website(lesson_record),
+    )
     
-    if state == 'awaiting_subject_text':
-        session['params']['subject'] = text
-        session['state'] = 'awaiting_topic'
-        keyboard = [
-            [InlineKeyboardButton(t('topic_custom', lang), callback_data="topic_custom")],
-        ]
-        summary = build_selection_summary(session['params'], lang)
+    if website_pushed:
         await update.message.reply_text(
-            f"{summary}\n\n{t('topic_prompt', lang)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
+            t('share_success', lang),
+            reply_markup=NEXT_STEP_MARKUP[lang],
+            parse_mode=ParseMode.HTML
         )
-        return
-    
-    if state == 'awaiting_topic_text':
-        session['params']['topic'] = text
-        session['state'] = 'awaiting_ages'
-        keyboard = [
-            [InlineKeyboardButton("5-7", callback_data="ages_5-7"),
-             InlineKeyboardButton("7-9", callback_data="ages_7-9"),
-             InlineKeyboardButton("9-11", callback_data="ages_9-11")],
-            [InlineKeyboardButton("11-13", callback_data="ages_11-13"),
-             InlineKeyboardButton("13-15", callback_data="ages_13-15"),
-             InlineKeyboardButton("15+", callback_data="ages_15-18")],
-        ]
-        summary = build_selection_summary(session['params'], lang)
+    else:
         await update.message.reply_text(
-            f"{summary}\n\n{t('ages_prompt', lang)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
+            t('share_success_basic', lang),
+            reply_markup=NEXT_STEP_MARKUP[lang],
+            parse_mode=ParseMode.HTML
         )
-        return
     
-    await update.message.reply_text(t('use_start', lang))
+    session.state = State.IDLE
+    session.last_lesson = None
+
+
+# TYPED SUBJECT → TOPIC
+async def text_subject(update, context, session, lang, text):
+    session.params['subject'] = text
+    session.state = State.AWAITING_TOPIC
+    summary = build_selection_summary(session.params, lang)
+    await update.message.reply_text(
+        f"{summary}\n\n{t('topic_prompt', lang)}",
+        reply_markup=TOPIC_CUSTOM_MARKUP[lang],
+        parse_mode=ParseMode.HTML
+    )
+
+
+# TYPED TOPIC → AGES
+async def text_topic(update, context, session, lang, text):
+    session.params['topic'] = text
+    session.state = State.AWAITING_AGES
+    summary = build_selection_summary(session.params, lang)
+    await update.message.reply_text(
+        f"{summary}\n\n{t('ages_prompt', lang)}",
+        reply_markup=AGES_MARKUP,
+        parse_mode=ParseMode.HTML
+    )
+
+
+# Conversation state -> handler for the user's next typed (or transcribed) message
+TEXT_HANDLERS = {
+    State.AWAITING_FEEDBACK: text_feedback,
+    State.AWAITING_TEACHER_NAME: text_teacher_name,
+    State.AWAITING_SUBJECT_TEXT: text_subject,
+    State.AWAITING_TOPIC_TEXT: text_topic,
+}
+
+
+async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await handle_text(update, context, update.message.text.strip())
+
+
+async def handle_text(update, context, text):
+    user_id = update.effective_user.id
+    session = get_session(user_id)
+    lang = get_lang(user_id)
+    state = session.state
+    
+    logger.info(f"Text from {user_id}: '{text[:30]}...' state={state}")
+    
+    handler = TEXT_HANDLERS.get(state)
+    if handler is None:
+        await update.message.reply_text(t('use_start', lang))
+        return
+    await handler(update, context, session, lang, text)
 
 
 # ============================================================================
@@ -1786,26 +2242,29 @@ async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(t('voice_not_configured', lang))
         return
     
-    voice_file = await context.bot.get_file(update.message.voice.file_id)
-    voice_data = await voice_file.download_as_bytearray()
-    
     try:
+        # Show "typing..." while the clip downloads rather than after it has
+        voice_file, _ = await asyncio.gather(
+            context.bot.get_file(update.message.voice.file_id),
+            context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING),
+        )
+        voice_data = await voice_file.download_as_bytearray()
+        
         # Use Spanish transcription if user's language is Spanish
         transcription_lang = "es" if lang == "es" else "en"
         
-        transcription = groq_client.audio.transcriptions.create(
+        transcription = await groq_client.audio.transcriptions.create(
             file=("voice.ogg", bytes(voice_data)),
             model="whisper-large-v3",
             language=transcription_lang
         )
         text = transcription.text.strip()
         if text:
-            update.message.text = text
-            await text_handler(update, context)
+            await handle_text(update, context, text)
         else:
             await update.message.reply_text(t('voice_unclear', lang))
-    except Exception as e:
-        logger.error(f"Voice error: {e}")
+    except Exception:
+        logger.exception("Voice error")
         await update.message.reply_text(t('voice_error', lang))
 
 
@@ -1813,24 +2272,58 @@ async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # MAIN
 # ============================================================================
 
+_session_sweep_task = None
+
+
+async def post_init(application):
+    global _github_flush_task, _session_sweep_task
+    _github_flush_task = asyncio.create_task(github_flush_loop())
+    _session_sweep_task = asyncio.create_task(session_sweep_loop())
+
+
+async def post_shutdown(application):
+    if _github_flush_task:
+        # Let the loop requeue a half-collected batch before the final flush drains the queue
+        _github_flush_task.cancel()
+        await asyncio.gather(_github_flush_task, return_exceptions=True)
+    if _session_sweep_task:
+        _session_sweep_task.cancel()
+    await flush_github_queue()
+    await github_client.aclose()
+    await model_http_client.aclose()
+    _render_pool.shutdown(wait=False)
+    _pdf_pool.shutdown(wait=False)
+    await session_store.close()
+
+
 def main():
     logger.info(f"Starting Tooley Bot v{VERSION}")
     logger.info(f"GITHUB_TOKEN: {'SET' if GITHUB_TOKEN else 'NOT SET'}")
     logger.info(f"GITHUB_REPO: {GITHUB_REPO}")
     logger.info(f"GITHUB_WEBSITE_REPO: {GITHUB_WEBSITE_REPO or 'NOT SET'}")
     
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
-    
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("lesson", lesson_command))
-    application.add_handler(CommandHandler("about", about_command))
-    application.add_handler(CommandHandler("subjects", subjects_command))
-    application.add_handler(CommandHandler("feedback", feedback_command))
-    application.add_handler(CommandHandler("language", language_command))
-    application.add_handler(CallbackQueryHandler(callback_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
-    application.add_handler(MessageHandler(filters.VOICE, voice_handler))
+    # Outbound calls are paced under Telegram's global and per-chat flood limits, and a 429
+    # is retried after its RetryAfter instead of failing the handler
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    
+    application.add_handler(CommandHandler("start", serialized(start_command)))
+    application.add_handler(CommandHandler("help", serialized(help_command)))
+    application.add_handler(CommandHandler("lesson", serialized(lesson_command)))
+    application.add_handler(CommandHandler("about", serialized(about_command)))
+    application.add_handler(CommandHandler("subjects", serialized(subjects_command)))
+    application.add_handler(CommandHandler("feedback", serialized(feedback_command)))
+    application.add_handler(CommandHandler("language", serialized(language_command)))
+    application.add_handler(CallbackQueryHandler(serialized(callback_handler)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, serialized(text_handler)))
+    application.add_handler(MessageHandler(filters.VOICE, serialized(voice_handler)))
     
     logger.info("Bot starting...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)